@@ -1,11 +1,33 @@
 import logging
+import logging.handlers
+import queue
 import os
 import re
 import random
+import secrets
 import string
 import asyncio
+import atexit
+import time
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from enum import IntEnum
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    BotCommand,
+    Message,
+)
+from telegram.error import (
+    BadRequest as TelegramBadRequest,
+    NetworkError as TelegramNetworkError,
+    TelegramError,
+)
 from telegram.ext import (
     Application,  # <-- Bu qatorni qo'shing
     CommandHandler,
@@ -15,26 +37,43 @@ from telegram.ext import (
     filters,
 )
 from dotenv import load_dotenv
-from pyrogram import Client as PyrogramClient
+from pyrogram import Client as PyrogramClient, raw, utils as pyrogram_utils
 from pyrogram.errors import (
     BadRequest,
+    ChannelInvalid,
+    ChannelPrivate,
     FloodWait,
+    PeerIdInvalid,
+    RPCError,
+    UsernameInvalid,
+    UsernameNotOccupied,
     SessionPasswordNeeded,
     PhoneCodeInvalid,
     PhoneNumberInvalid,
 )
 import pytz
-import json
+import orjson
 from pathlib import Path
 from telegram.constants import ParseMode
 
-# Loglarni sozlash
+try:
+    import uvloop  # Tezroq event loop (Windows'da mavjud emas)
+except ImportError:
+    uvloop = None
+
+# Loglarni sozlash: handlerlar yozuvni navbatga qo'yadi, faylga yozishni
+# alohida oqimdagi QueueListener bajaradi (event loop diskni kutmaydi)
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
-    filename="bot.log",
-    filemode="w",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
 )
+# Yozuv navbatga qo'yilishidan oldin formatlanadi, fayl handleri uni o'zgartirmaydi
+_log_file_handler = logging.FileHandler("bot.log", mode="w", encoding="utf-8")
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 # Ma'lumotlarni saqlash uchun sozlash
 DATA_DIR = Path("data")
@@ -45,8 +84,14 @@ load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_ID = int(os.getenv("ADMIN_ID")) if os.getenv("ADMIN_ID") else None
+ADMIN_IDS = frozenset({ADMIN_ID} if ADMIN_ID else ())
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
+# Berilsa bot webhook orqali ishlaydi, aks holda polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+PORT = int(os.getenv("PORT", "8443"))
+# Bot API so'rovlari uchun ochiq ulanishlar soni (concurrent_updates bilan)
+BOT_API_POOL_SIZE = 32
 
 # Majburiy muhit o'zgaruvchilarini tekshirish
 if not all([TOKEN, API_ID, API_HASH]):
@@ -62,44 +107,308 @@ if not all([TOKEN, API_ID, API_HASH]):
     print("Iltimos, .env faylini tekshiring va botni qayta ishga tushiring")
     exit(1)
 
+# Pyrogram api_id ni int sifatida kutadi - har ulanishda emas, bir marta o'giriladi
+if not API_ID.isdigit():
+    logger.error(f"API_ID faqat raqamlardan iborat bo'lishi kerak: {API_ID}")
+    print("XATO: API_ID faqat raqamlardan iborat bo'lishi kerak")
+    exit(1)
+API_ID = int(API_ID)
+
 # Ma'lumotlar fayllari
-USER_DATA_FILE = DATA_DIR / "user_data.json"
 PREMIUM_USERS_FILE = DATA_DIR / "premium_users.json"
 GENERATED_KEYS_FILE = DATA_DIR / "generated_keys.json"
 PENDING_REQUESTS_FILE = DATA_DIR / "pending_requests.json"
 TELEGRAM_ACCOUNTS_FILE = DATA_DIR / "telegram_accounts.json"
 USER_GROUPS_FILE = DATA_DIR / "user_groups.json"
 AUTO_FOLDERS_FILE = DATA_DIR / "auto_folders.json"
+SCHEDULES_FILE = DATA_DIR / "schedules.json"
+
+# Kalitlari Telegram user_id (int) bo'lgan fayllar - JSON ularni satrga aylantiradi
+_INT_KEY_FILES = {
+    PREMIUM_USERS_FILE,
+    PENDING_REQUESTS_FILE,
+    TELEGRAM_ACCOUNTS_FILE,
+    USER_GROUPS_FILE,
+    AUTO_FOLDERS_FILE,
+    SCHEDULES_FILE,
+}
+
+# Oldindan kompilyatsiya qilingan regexlar
+_PHONE_RE = re.compile(r"^\+[0-9]{10,14}$")
+_NON_DIGIT_RE = re.compile(r"[^0-9]")
+_CODE_RE = re.compile(r"^[\d_]+$")
+# https://t.me/nom, t.me/nom?x=1, @nom yoki nom -> "nom"
+_GROUP_LINK_RE = re.compile(r"^(?:https?://)?(?:t\.me/|@)?([^/?#]+)")
+
+# O'zgarmas klaviaturalar (har chaqiruvda qayta yaratilmaydi)
+BACK_TO_START_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
+)
+HOME_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🏠 Bosh menyu", callback_data="back_to_start")]]
+)
+MAIN_MENU_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🏠 Asosiy menyu", callback_data="back_to_start")]]
+)
+RESEND_CODE_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🔄 Qayta yuborish", callback_data="resend_code")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+NEW_CODE_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🔄 Yangi kod so'rash", callback_data="resend_code")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+CONNECT_ACCOUNT_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("📲 Telegramni ulash", callback_data="connect_account")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+ACCOUNT_INFO_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("❌ Uzish", callback_data="disconnect_account")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+ADD_GROUP_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("➕ Guruh Qo'shish", callback_data="add_group")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+GROUP_ADD_BACK_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+GROUP_ADDED_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
+        [InlineKeyboardButton("📋 Mening guruhlarim", callback_data="list_groups")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+CONFIRM_GROUP_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("✅ Ha", callback_data="confirm_add")],
+        [InlineKeyboardButton("❌ Yo'q", callback_data="cancel_add")],
+    ]
+)
+PREMIUM_REQUIRED_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🆙 Premium so'rov", callback_data="request_premium")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+SEND_MESSAGE_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("✉️ Xabar Yuborish", callback_data="send_message")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+ADMIN_HOME_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]]
+)
+ADMIN_BACK_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")]]
+)
+START_MENU_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🏠 Menyu", callback_data="start")]]
+)
+# error_handler uchun (inglizcha matn bilan)
+ERROR_FALLBACK_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]]
+)
+RETRY_KEY_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔄 Qayta urinish", callback_data="activate_key")]]
+)
+RETRY_KEY_OR_REQUEST_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🔄 Qayta urinish", callback_data="activate_key")],
+        [InlineKeyboardButton("🆙 Premium so'rov", callback_data="request_premium")],
+    ]
+)
+CONTACT_ADMIN_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("Admin bilan bog'lanish", url=f"t.me/{ADMIN_USERNAME}")]]
+)
+STOP_MESSAGES_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🛑 To'xtatish", callback_data="stop_messages")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+SET_INTERVAL_BACK_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔙 Orqaga", callback_data="set_interval")]]
+)
+INTERVAL_MENU_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("1 min", callback_data="interval_1")],
+        [InlineKeyboardButton("2 min", callback_data="interval_2")],
+        [InlineKeyboardButton("5 min", callback_data="interval_5")],
+        [InlineKeyboardButton("10 min", callback_data="interval_10")],
+        [InlineKeyboardButton("30 min", callback_data="interval_30")],
+        [InlineKeyboardButton("✏️ Boshqa", callback_data="custom_interval")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+    ]
+)
+ADMIN_PANEL_KB = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton(
+                "🔑 Premium kalit yaratish", callback_data="generate_key"
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "📊 Premium foydalanuvchilar", callback_data="premium_users_list"
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "📨 Kutilayotgan so'rovlar", callback_data="pending_requests"
+            )
+        ],
+        [InlineKeyboardButton("🏠 Bosh menyu", callback_data="back_to_start")],
+    ]
+)
+# /admin buyrug'i uchun (bosh menyu tugmasisiz)
+ADMIN_COMMAND_KB = InlineKeyboardMarkup(ADMIN_PANEL_KB.inline_keyboard[:-1])
+# Premium ma'lumot: obuna yo'q bo'lganda (admin bo'lsa so'rov tugmasi bilan)
+NO_PREMIUM_INFO_KB = InlineKeyboardMarkup(
+    (
+        [[InlineKeyboardButton("🆙 Premium so'rov", callback_data="request_premium")]]
+        if ADMIN_ID
+        else []
+    )
+    + [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
+)
+# Premium bo'lmagan foydalanuvchilar uchun asosiy menyu
+NON_PREMIUM_MENU_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🆙 Premium so'rov", callback_data="request_premium")],
+        [
+            InlineKeyboardButton(
+                "🔑 Kalitni faollashtirish", callback_data="activate_key"
+            )
+        ],
+    ]
+)
+# Premium foydalanuvchilar uchun asosiy menyu
+PREMIUM_MENU_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
+        [InlineKeyboardButton("📋 Mening guruhlarim", callback_data="list_groups")],
+        [
+            InlineKeyboardButton(
+                "📲 Telegram hisobini ulash", callback_data="connect_account"
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                "📂 Avto-papka yaratish", callback_data="create_auto_folder"
+            )
+        ],
+        [InlineKeyboardButton("✉️ Xabar yuborish", callback_data="send_message")],
+        [InlineKeyboardButton("⚙️ Intervalni sozlash", callback_data="set_interval")],
+        [InlineKeyboardButton("⭐ Premium ma'lumot", callback_data="premium_info")],
+    ]
+)
+# Kalit muddatini tanlash menyusi
+GENKEY_MENU_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("1 oy", callback_data="genkey_30")],
+        [InlineKeyboardButton("3 oy", callback_data="genkey_90")],
+        [InlineKeyboardButton("6 oy", callback_data="genkey_180")],
+        [InlineKeyboardButton("1 yil", callback_data="genkey_365")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")],
+    ]
+)
+
+
+class State(IntEnum):
+    """Foydalanuvchi suhbatining bosqichi (matnli xabar qaysi handlerga boradi)"""
+
+    IDLE = 0
+    WAITING_API_ID = 1
+    WAITING_API_HASH = 2
+    WAITING_PHONE_NUMBER = 3
+    WAITING_VERIFICATION_CODE = 4
+    WAITING_PASSWORD = 5
+    WAITING_GROUP_LINK = 6
+    CONFIRMING_GROUP = 7
+    WAITING_KEY_ACTIVATION = 8
+    WAITING_MESSAGE = 9
+    WAITING_INTERVAL = 10
+
+
+@dataclass(slots=True)
+class UserSession:
+    """Foydalanuvchining joriy holati va vaqtinchalik ma'lumotlari"""
+
+    state: State = State.IDLE
+    message: str = ""
+    preview: str = ""  # message ning qisqartirilgan ko'rinishi
+    interval: int | None = None
+    temp_group: dict | None = None
+    # Holat o'rnatilgan vaqt (time.monotonic) - tashlab ketilgan jarayonlarni tozalash uchun
+    updated: float = field(default_factory=time.monotonic)
+
 
 # Ma'lumotlar tuzilmalari
 user_groups = {}  # {user_id: {chat_id: {"title": str, "link": str}}}
-user_data = {}  # Foydalanuvchi holatlari va vaqtinchalik ma'lumotlar
-message_jobs = {}  # Faol xabar ishlari
+user_data = defaultdict(UserSession)  # {user_id: UserSession} - faqat xotirada
+message_jobs = {}  # {user_id: Job} - faol xabar ishlari
+schedules = (
+    {}
+)  # {user_id: {"message": str, "interval": int}} - qayta ishga tushganda tiklanadi
 premium_users = (
     {}
-)  # {user_id: {"expiry": datetime, "key": str, "admin_id": int, "days": int}}
+)  # {user_id: {"expiry": datetime, "key": str, "admin_id": int, "days": int, "username": str}}
 pending_requests = {}  # {user_id: {"username": str, "date": datetime, "user_id": int}}
 generated_keys = (
     {}
 )  # {key: {"user_id": int, "expiry": datetime, "admin_id": int, "days": int}}
-telegram_accounts = (
-    {}
-)  # {user_id: {"phone": str, "client": PyrogramClient, "session": str}}
+telegram_accounts = {}  # {user_id: {"phone": str, "session": str}}
 auto_folders = (
     {}
 )  # {user_id: {"folder_id": int, "title": str, "groups": [chat_id1, chat_id2,...]}}
+active_clients = (
+    {}
+)  # {user_id: PyrogramClient} - ulangan clientlar (faylga saqlanmaydi)
+_client_last_used = {}  # {user_id: time.monotonic()} - oxirgi foydalanish vaqti
+_login_clients = {}  # {user_id: PyrogramClient} - login jarayonidagi (faqat connect())
+CLIENT_IDLE_TIMEOUT = 15 * 60  # soniya
+PENDING_REQUEST_TTL_DAYS = 7  # shundan eski premium so'rovlar o'chiriladi
+SESSION_TTL = 10 * 60  # soniya - tugallanmagan jarayon shundan keyin bekor qilinadi
 
 
 def load_data(file_path, default_value):
     """JSON faylidan ma'lumotlarni yuklash va datetime bilan ishlash"""
     try:
         if file_path.exists():
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if file_path in [PREMIUM_USERS_FILE, GENERATED_KEYS_FILE]:
+            with open(file_path, "rb") as f:
+                data = orjson.loads(f.read())
+                if file_path == USER_GROUPS_FILE:
+                    # {user_id: {group_id: ...}} - ikkala daraja ham int
+                    data = {
+                        int(uid): {int(gid): g for gid, g in groups.items()}
+                        for uid, groups in data.items()
+                    }
+                elif file_path in _INT_KEY_FILES:
+                    data = {int(k): v for k, v in data.items()}
+                if file_path in (PREMIUM_USERS_FILE, GENERATED_KEYS_FILE):
                     for key, value in data.items():
                         if "expiry" in value and isinstance(value["expiry"], str):
                             value["expiry"] = datetime.fromisoformat(value["expiry"])
+                elif file_path == PENDING_REQUESTS_FILE:
+                    for value in data.values():
+                        if isinstance(value.get("date"), str):
+                            value["date"] = datetime.fromisoformat(value["date"])
                 return data
         return default_value
     except Exception as e:
@@ -107,243 +416,387 @@ def load_data(file_path, default_value):
         return default_value
 
 
-def load_data(file_path, default_value):
-    """JSON faylidan ma'lumotlarni yuklash va datetime bilan ishlash"""
-    try:
-        if file_path.exists():
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if file_path in [PREMIUM_USERS_FILE, GENERATED_KEYS_FILE]:
-                    for key, value in data.items():
-                        if "expiry" in value and isinstance(value["expiry"], str):
-                            value["expiry"] = datetime.fromisoformat(value["expiry"])
-                return data
-        return default_value
-    except Exception as e:
-        logger.error(f"{file_path} yuklashda xato: {str(e)}")
-        return default_value
+def _encode(data):
+    """Ma'lumotni ixcham JSON baytlariga aylantirish (datetime orjson tomonidan)"""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _write_file(file_path, payload):
+    """Tayyor baytlarni faylga yozish (vaqtinchalik fayl orqali, atomar)"""
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    # Yozish yarim yo'lda uzilsa ham eski fayl buzilmaydi
+    os.replace(tmp_path, file_path)
 
 
 def save_data(file_path, data):
     """JSON fayliga ma'lumotlarni saqlash va datetime bilan ishlash"""
     try:
-
-        def json_serializer(obj):
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            raise TypeError(f"{type(obj)} turidagi obyekt JSON uchun mos emas")
-
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2, default=json_serializer)
+        _write_file(file_path, _encode(data))
     except Exception as e:
         logger.error(f"{file_path} saqlashda xato: {str(e)}")
 
 
-# Ishga tushganda barcha ma'lumotlarni yuklash
-user_data = load_data(USER_DATA_FILE, {})
-premium_users = load_data(PREMIUM_USERS_FILE, {})
-generated_keys = load_data(GENERATED_KEYS_FILE, {})
-pending_requests = load_data(PENDING_REQUESTS_FILE, {})
-telegram_accounts = load_data(TELEGRAM_ACCOUNTS_FILE, {})
-user_groups = load_data(USER_GROUPS_FILE, {})
-auto_folders = load_data(AUTO_FOLDERS_FILE, {})
+# Ishga tushganda barcha ma'lumotlarni yuklash (fayllar parallel o'qiladi)
+with ThreadPoolExecutor(thread_name_prefix="load") as _pool:
+    (
+        premium_users,
+        generated_keys,
+        pending_requests,
+        telegram_accounts,
+        user_groups,
+        auto_folders,
+        schedules,
+    ) = _pool.map(
+        lambda file_path: load_data(file_path, {}),
+        (
+            PREMIUM_USERS_FILE,
+            GENERATED_KEYS_FILE,
+            PENDING_REQUESTS_FILE,
+            TELEGRAM_ACCOUNTS_FILE,
+            USER_GROUPS_FILE,
+            AUTO_FOLDERS_FILE,
+            SCHEDULES_FILE,
+        ),
+    )
+# {user_id: {username}} - takroriy guruhni ro'yxatni aylanmasdan aniqlash uchun
+_group_usernames = defaultdict(
+    set,
+    {
+        uid: {g.get("username") for g in groups.values()}
+        for uid, groups in user_groups.items()
+    },
+)
+
+# Kechiktirilgan saqlash: handlerlar faqat faylni belgilaydi, yozish esa
+# bitta davriy ishda (flush_dirty_job) bajariladi
+SAVE_INTERVAL = 2  # soniya
+_STORES = {
+    PREMIUM_USERS_FILE: premium_users,
+    GENERATED_KEYS_FILE: generated_keys,
+    PENDING_REQUESTS_FILE: pending_requests,
+    TELEGRAM_ACCOUNTS_FILE: telegram_accounts,
+    USER_GROUPS_FILE: user_groups,
+    AUTO_FOLDERS_FILE: auto_folders,
+    SCHEDULES_FILE: schedules,
+}
+_dirty_files = set()
+# Fayl yozish uchun alohida oqim: yozuvlar ketma-ket bajariladi va
+# umumiy to_thread pulini band qilmaydi
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+
+
+def mark_dirty(*file_paths):
+    """Fayllarni keyingi saqlash siklida yozish uchun belgilash"""
+    _dirty_files.update(file_paths)
+
+
+def flush_dirty():
+    """Belgilangan barcha fayllarni bir martada saqlash"""
+    while _dirty_files:
+        file_path = _dirty_files.pop()
+        save_data(file_path, _STORES[file_path])
+
+
+# Jarayon kutilmaganda tugasa ham (post_shutdown ishlamasa) ma'lumotlar yoziladi
+atexit.register(flush_dirty)
+
+
+async def flush_dirty_job(context: ContextTypes.DEFAULT_TYPE):
+    """Davriy saqlash ishi"""
+    while _dirty_files:
+        file_path = _dirty_files.pop()
+        try:
+            # Lug'at event loop'da seriyalanadi (handlerlar uni o'zgartirib
+            # turadi), diskka yozish esa alohida oqimda bajariladi
+            payload = _encode(_STORES[file_path])
+            await asyncio.get_running_loop().run_in_executor(
+                _io_pool, _write_file, file_path, payload
+            )
+        except Exception as e:
+            logger.error(f"{file_path} saqlashda xato: {str(e)}")
+
+
+def _session_of(user_id):
+    """Foydalanuvchining saqlangan Pyrogram session satri (ulanmagan bo'lsa None)"""
+    account = telegram_accounts.get(user_id)
+    return account.get("session") if account else None
 
 
 async def is_premium(user_id: int) -> bool:
     """Foydalanuvchining faol premium obunasi borligini tekshirish"""
-    if user_id in premium_users:
-        expiry = premium_users[user_id]["expiry"]
-        if isinstance(expiry, str):
-            expiry = datetime.fromisoformat(expiry)
-        return expiry > datetime.now()
-    return False
+    # expiry load_data da bir marta datetime ga aylantiriladi
+    entry = premium_users.get(user_id)
+    return entry is not None and entry["expiry"] > datetime.now()
+
+
+def get_expiry_str(entry: dict) -> str:
+    """Tugash sanasini formatlangan holda qaytarish (strftime bir marta chaqiriladi)"""
+    expiry_str = entry.get("expiry_str")
+    if expiry_str is None:
+        expiry_str = entry["expiry"].strftime("%Y-%m-%d")
+        entry["expiry_str"] = expiry_str
+    return expiry_str
+
+
+async def edit_if_changed(query, text, reply_markup=None, **kwargs):
+    """Xabarni faqat matn yoki tugmalar o'zgargan bo'lsa tahrirlash"""
+    # Oddiy xabar orqali chaqirilganda (masalan, qo'lda kiritilgan interval) javob yuboriladi
+    if isinstance(query, Message):
+        return await query.reply_text(text, reply_markup=reply_markup, **kwargs)
+
+    # Callback xabarining joriy holati bilan solishtirish - bir xil bo'lsa so'rov yuborilmaydi
+    message = query.message
+    try:
+        if message is not None:
+            current = message.text_html if kwargs.get("parse_mode") else message.text
+            if current == text:
+                if message.reply_markup == reply_markup:
+                    return None
+                # Faqat tugmalar o'zgargan - matnni qayta yubormaslik
+                return await query.edit_message_reply_markup(reply_markup=reply_markup)
+        return await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    except TelegramBadRequest as e:
+        # Telegram matnni normallashtiradi (oxiridagi bo'shliqlar va h.k.), shuning
+        # uchun yuqoridagi solishtiruv ba'zan o'tkazib yuboradi - bu xato emas
+        if "message is not modified" not in str(e).lower():
+            raise
+        return None
+
+
+async def answer_quietly(query, text=None):
+    """Callback so'roviga javob berish (xato bo'lsa faqat loglanadi)"""
+    # Javob kechiksa Telegram "query is too old" qaytaradi - bu handler natijasiga
+    # ta'sir qilmasligi va error_handler xabarni almashtirmasligi kerak
+    try:
+        await query.answer(text)
+    except TelegramError as e:
+        logger.error(f"Callback javobi xatosi: {str(e)}")
+
+
+_user_locks = defaultdict(asyncio.Lock)  # {user_id: asyncio.Lock}
+
+
+def per_user_lock(func):
+    """Bitta foydalanuvchining yangilanishlarini navbat bilan bajarish"""
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        # Turli foydalanuvchilar parallel ishlanadi, bitta foydalanuvchi - ketma-ket
+        user = update.effective_user
+        if user is None:
+            return await func(update, context, *args, **kwargs)
+        async with _user_locks[user.id]:
+            # Faol foydalanuvchining sessiyasi expire_stale_sessions da o'chirilmasin
+            session = user_data.get(user.id)
+            if session is not None:
+                session.updated = time.monotonic()
+            return await func(update, context, *args, **kwargs)
+
+    return wrapper
+
+
+# Tugma bosish tezligi chegarasi (bosish/soniya) - ortiqchasi handlergacha yetmaydi
+CALLBACK_RATE = 5
+CALLBACK_BURST = 5
+_callback_buckets = {}  # {user_id: TokenBucket}
 
 
-async def is_admin(user_id: int) -> bool:
-    """Foydalanuvchi admin ekanligini tekshirish"""
-    return user_id == ADMIN_ID
+def rate_limited(func):
+    """Tugmalarni juda tez bosishni cheklash (lock va I/O dan oldin tekshiriladi)"""
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        user_id = update.effective_user.id
+        bucket = _callback_buckets.get(user_id)
+        if bucket is None:
+            bucket = _callback_buckets[user_id] = TokenBucket(
+                CALLBACK_RATE, CALLBACK_BURST
+            )
+        if not bucket.try_acquire():
+            await answer_quietly(update.callback_query, "⏳")
+            return
+        # Tugma per_user_lock dan oldin tasdiqlanadi - shu foydalanuvchining sekin
+        # bosqichi (masalan, FloodWait kutish) tugashini kutib spinner aylanmaydi
+        context.application.create_task(answer_quietly(update.callback_query))
+        return await func(update, context, *args, **kwargs)
+
+    return wrapper
+
+
+def with_error_reply(
+    log_message,
+    text="❌ Xato yuz berdi. Iltimos, qayta urinib ko'ring.",
+    reply_markup=BACK_TO_START_KB,
+):
+    """Handler xatosini loglash va foydalanuvchiga umumiy klaviatura bilan javob berish"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except TelegramNetworkError as e:
+                # Telegram so'rovining o'zi bajarilmadi - yana tahrir yuborish foydasiz
+                logger.error(f"{log_message}: {str(e)}")
+            except Exception as e:
+                logger.error(f"{log_message}: {str(e)}")
+                target = args[0]
+                if isinstance(target, Update):
+                    target = target.callback_query or target.message
+                await edit_if_changed(target, text, reply_markup=reply_markup)
+
+        return wrapper
+
+    return decorator
+
+
+def admin_only(func):
+    """Faqat ADMIN_IDS dagi foydalanuvchilarga ruxsat berish"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        query = args[0]
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("❌ Faqat adminlar uchun!")
+            return
+        return await func(*args, **kwargs)
+
+    return wrapper
+
+
+_KEY_CHARS = string.ascii_uppercase + string.digits
 
 
 def generate_key(length=12):
-    """Tasodifiy premium kalit yaratish"""
-    chars = string.ascii_uppercase + string.digits
-    return "PREMIUM-" + "".join(random.choice(chars) for _ in range(length))
+    """Tasodifiy premium kalit yaratish (kriptografik tasodifiy manba)"""
+    return "PREMIUM-" + "".join(secrets.choice(_KEY_CHARS) for _ in range(length))
+
+
+def is_valid_key_format(key: str) -> bool:
+    """Kalit PREMIUM-XXXXXXXX ko'rinishida ekanligini tekshiradi (regexsiz)"""
+    suffix = key[8:]
+    return (
+        key.startswith("PREMIUM-")
+        and 8 <= len(suffix) <= 12
+        and suffix.isascii()
+        and suffix.isalnum()
+        # isupper() faqat raqamlardan iborat qatorda False qaytaradi
+        and suffix == suffix.upper()
+    )
 
 
 async def check_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if await is_premium(user_id):
-        expiry = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
+        expiry = get_expiry_str(premium_users[user_id])
         await update.message.reply_text(f"✅ Premium faol (tugash sanasi: {expiry})")
     else:
         await update.message.reply_text("❌ Faol premium obuna yo'q")
 
 
-async def is_premium(user_id: int) -> bool:
-    """Foydalanuvchining faol premium obunasi borligini tekshirish"""
-    if user_id in premium_users:
-        expiry = premium_users[user_id]["expiry"]
-        if isinstance(expiry, str):
-            expiry = datetime.fromisoformat(expiry)
-        return expiry > datetime.now()
-    return False
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     message = update.message or update.callback_query.message
     username = update.effective_user.username or "foydalanuvchi"
 
     if not await is_premium(user_id):
-        buttons = [
-            [
-                InlineKeyboardButton(
-                    "🆙 Premium so'rov", callback_data="request_premium"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "🔑 Kalitni faollashtirish", callback_data="activate_key"
-                )
-            ],
-        ]
         await message.reply_text(
             f"Salom @{username}!\n\n❌ Sizda premium obuna yo'q",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=NON_PREMIUM_MENU_KB,
         )
         return
 
-    # Premium foydalanuvchilar uchun asosiy menyu
-    keyboard = [
-        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-        [InlineKeyboardButton("📋 Mening guruhlarim", callback_data="list_groups")],
-        [
-            InlineKeyboardButton(
-                "📲 Telegram hisobini ulash", callback_data="connect_account"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "📂 Avto-papka yaratish", callback_data="create_auto_folder"
-            )
-        ],
-        [InlineKeyboardButton("✉️ Xabar yuborish", callback_data="send_message")],
-        [InlineKeyboardButton("⚙️ Intervalni sozlash", callback_data="set_interval")],
-        [InlineKeyboardButton("⭐ Premium ma'lumot", callback_data="premium_info")],
-    ]
-    expiry_date = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
+    expiry_date = get_expiry_str(premium_users[user_id])
     await message.reply_text(
         f"⭐ Premium faol @{username}\n📅 Tugash sanasi: {expiry_date}",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=PREMIUM_MENU_KB,
     )
 
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin panelini ko'rsatish"""
-    if not await is_admin(update.effective_user.id):
+    if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("❌ Faqat adminlar uchun!")
         return
 
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "🔑 Premium kalit yaratish", callback_data="generate_key"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "📊 Premium foydalanuvchilar", callback_data="premium_users_list"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "📨 Kutilayotgan so'rovlar", callback_data="pending_requests"
-            )
-        ],
-    ]
     await update.message.reply_text(
         "🛠 Admin paneli:\n\nIltimos, variantni tanlang:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=ADMIN_COMMAND_KB,
     )
 
 
-async def show_premium_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Premium foydalanuvchilar ro'yxatini ko'rsatish"""
-    query = update.callback_query
-    await query.answer()
+@admin_only
+async def show_admin_panel(query):
+    """Admin panelini callback orqali ko'rsatish"""
+    await edit_if_changed(
+        query,
+        "🛠 Admin paneli:\n\nIltimos, amalni tanlang:",
+        reply_markup=ADMIN_PANEL_KB,
+    )
 
-    if not await is_admin(query.from_user.id):
-        await query.edit_message_text("❌ Faqat adminlar uchun!")
-        return
 
+@admin_only
+async def show_premium_users_list(query, context):
+    """Premium foydalanuvchilar ro'yxatini ko'rsatish"""
     if not premium_users:
-        await query.edit_message_text("ℹ️ Hozircha premium foydalanuvchilar yo'q")
+        await edit_if_changed(query, "ℹ️ Hozircha premium foydalanuvchilar yo'q")
         return
 
-    message = "⭐ Premium foydalanuvchilar:\n\n"
+    lines = ["⭐ Premium foydalanuvchilar:\n\n"]
     for user_id, data in premium_users.items():
-        username = next(
-            (
-                req["username"]
-                for req in pending_requests.values()
-                if req.get("user_id") == user_id
-            ),
-            "Noma'lum",
+        username = data.get("username") or "Noma'lum"
+        expiry = get_expiry_str(data)
+        lines.append(
+            f"👤 {username} (ID: {user_id})\n"
+            f"📅 Tugash sanasi: {expiry}\n"
+            f"⏳ Davomiylik: {data['days']} kun\n\n"
         )
-        expiry = data["expiry"].strftime("%Y-%m-%d")
-        message += f"👤 {username} (ID: {user_id})\n"
-        message += f"📅 Tugash sanasi: {expiry}\n"
-        message += f"⏳ Davomiylik: {data['days']} kun\n\n"
+    message = "".join(lines)
 
-    await query.edit_message_text(
+    await edit_if_changed(
+        query,
         message,
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]]
-        ),
+        reply_markup=ADMIN_HOME_KB,
     )
 
 
+@admin_only
 async def show_pending_requests(query, context):
     """Kutilayotgan premium so'rovlarini ko'rsatish"""
-    if not await is_admin(query.from_user.id):
-        await query.edit_message_text("❌ Faqat adminlar uchun!")
-        return
-
     if not pending_requests:
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "ℹ️ Kutilayotgan so'rovlar yo'q.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]]
-            ),
+            reply_markup=ADMIN_HOME_KB,
         )
         return
 
-    message = "📨 Kutilayotgan premium so'rovlar:\n\n"
-    buttons = []
-
-    for user_id, request in pending_requests.items():
-        message += f"👤 @{request['username']} (ID: {user_id})\n"
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    f"✅ request['username'] ni tasdiqlash",
-                    callback_data=f"approve_{user_id}",
-                )
-            ]
-        )
-
-    buttons.append(
-        [InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]
+    lines = ["📨 Kutilayotgan premium so'rovlar:\n\n"]
+    lines += [
+        f"👤 @{request['username']} (ID: {user_id})\n"
+        for user_id, request in pending_requests.items()
+    ]
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"✅ Tasdiqlash {request['username']}",
+                callback_data=f"approve_{user_id}",
+            )
+        ]
+        for user_id, request in pending_requests.items()
+    ]
+    # Oxirgi qator - ADMIN_HOME_KB dagi tayyor tugma
+    buttons += ADMIN_HOME_KB.inline_keyboard
+    await edit_if_changed(
+        query, "".join(lines), reply_markup=InlineKeyboardMarkup(buttons)
     )
-    await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(buttons))
 
 
+@admin_only
 async def approve_user_request(query, context, user_id_to_approve):
     """Foydalanuvchi so'rovini tasdiqlash"""
-    if not await is_admin(query.from_user.id):
-        await query.edit_message_text("❌ Faqat adminlar uchun!")
-        return
-
     try:
         if user_id_to_approve not in pending_requests:
             await query.edit_message_text("❌ Foydalanuvchi so'rovi topilmadi!")
@@ -351,39 +804,36 @@ async def approve_user_request(query, context, user_id_to_approve):
 
         key = generate_key()
         expiry_date = datetime.now() + timedelta(days=30)
+        expiry_str = expiry_date.strftime("%Y-%m-%d")
 
+        user_info = pending_requests.pop(user_id_to_approve)
         premium_users[user_id_to_approve] = {
             "expiry": expiry_date,
+            "expiry_str": expiry_str,
             "key": key,
             "admin_id": ADMIN_ID,
             "days": 30,
+            "username": user_info.get("username"),
         }
 
-        generated_keys[key] = {
-            "user_id": user_id_to_approve,
-            "expiry": expiry_date,
-            "admin_id": ADMIN_ID,
-            "days": 30,
-        }
-
-        user_info = pending_requests.pop(user_id_to_approve)
-        save_data(PREMIUM_USERS_FILE, premium_users)
-        save_data(GENERATED_KEYS_FILE, generated_keys)
-        save_data(PENDING_REQUESTS_FILE, pending_requests)
-
-        await context.bot.send_message(
-            chat_id=user_id_to_approve,
-            text=f"🎉 Sizning premium so'rovingiz tasdiqlandi!\n\n"
-            f"🔑 Sizning premium kalitingiz: <code>{key}</code>\n"
-            f"📅 Tugash sanasi: {expiry_date.strftime('%Y-%m-%d')}\n\n"
-            f"Endi siz botning barcha funksiyalaridan foydalanishingiz mumkin!",
-            parse_mode="HTML",
-        )
-
-        await query.edit_message_text(
-            f"✅ @{user_info['username']} premiumga ega bo'ldi!\n" f"Kalit: {key}",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]]
+        # Muddat va boshqa ma'lumotlar premium_users[user_id] da saqlanadi
+        generated_keys[key] = {"user_id": user_id_to_approve}
+
+        mark_dirty(PREMIUM_USERS_FILE, GENERATED_KEYS_FILE, PENDING_REQUESTS_FILE)
+
+        # Foydalanuvchiga xabar va admin javobi bir-biriga bog'liq emas - parallel
+        await asyncio.gather(
+            context.bot.send_message(
+                chat_id=user_id_to_approve,
+                text=f"🎉 Sizning premium so'rovingiz tasdiqlandi!\n\n"
+                f"🔑 Sizning premium kalitingiz: <code>{key}</code>\n"
+                f"📅 Tugash sanasi: {expiry_str}\n\n"
+                f"Endi siz botning barcha funksiyalaridan foydalanishingiz mumkin!",
+                parse_mode="HTML",
+            ),
+            query.edit_message_text(
+                f"✅ @{user_info['username']} premiumga ega bo'ldi!\n" f"Kalit: {key}",
+                reply_markup=ADMIN_HOME_KB,
             ),
         )
 
@@ -391,29 +841,17 @@ async def approve_user_request(query, context, user_id_to_approve):
         logger.error(f"Tasdiqlash xatosi: {str(e)}")
         await query.edit_message_text(
             f"❌ Xato: {str(e)}",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")]]
-            ),
+            reply_markup=ADMIN_BACK_KB,
         )
 
 
+@admin_only
 async def show_key_generation_options(query):
     """Admin uchun kalit yaratish variantlarini ko'rsatish"""
-    if not await is_admin(query.from_user.id):
-        await query.edit_message_text("❌ Faqat adminlar uchun!")
-        return
-
-    keyboard = [
-        [InlineKeyboardButton("1 oy", callback_data="genkey_30")],
-        [InlineKeyboardButton("3 oy", callback_data="genkey_90")],
-        [InlineKeyboardButton("6 oy", callback_data="genkey_180")],
-        [InlineKeyboardButton("1 yil", callback_data="genkey_365")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")],
-    ]
-
-    await query.edit_message_text(
+    await edit_if_changed(
+        query,
         "🔑 Premium kalit yaratish:\n\nKalit davomiyligini tanlang:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=GENKEY_MENU_KB,
     )
 
 
@@ -426,10 +864,11 @@ async def generate_premium_key(query, context, days=30):
         generated_keys[key] = {
             "user_id": None,  # Faollashtirilganda o'rnatiladi
             "expiry": expiry_date,
+            "expiry_str": expiry_date.strftime("%Y-%m-%d"),
             "admin_id": ADMIN_ID,
             "days": days,
         }
-        save_data(GENERATED_KEYS_FILE, generated_keys)
+        mark_dirty(GENERATED_KEYS_FILE)
 
         return key, expiry_date
     except Exception as e:
@@ -437,29 +876,54 @@ async def generate_premium_key(query, context, days=30):
         raise
 
 
-async def activate_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Kalitni faollashtirish"""
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
+@admin_only
+async def _on_genkey(query, context, user_id, days):
+    """genkey_<kun> tugmasi"""
+    try:
+        key, _ = await generate_premium_key(query, context, days)
+        await query.edit_message_text(
+            f"✅ Premium kalit yaratildi:\n\n"
+            f"🔑 Kalit: <code>{key}</code>\n"
+            f"📅 Tugash sanasi: {generated_keys[key]['expiry_str']}\n"
+            f"⏳ Davomiyligi: {days} kun\n\n"
+            "Bu kalitni foydalanuvchiga yuboring.",
+            parse_mode="HTML",
+            reply_markup=ADMIN_HOME_KB,
+        )
+    except Exception as e:
+        logger.error(f"Kalit yaratishda xatolik: {str(e)}")
+        await query.edit_message_text(
+            f"❌ Xatolik: {str(e)}\n\nIltimos, qaytadan urinib ko'ring.",
+            reply_markup=ADMIN_BACK_KB,
+        )
+
+
+async def _on_approve(query, context, user_id, user_id_to_approve):
+    """approve_<id> tugmasi"""
+    await approve_user_request(query, context, user_id_to_approve)
 
+
+async def activate_key(query, user_id):
+    """Kalitni faollashtirish"""
     if await is_premium(user_id):
-        expiry_date = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
-        await query.edit_message_text(
-            f"ℹ️ Sizda allaqachon premium obuna mavjud (tugash sanasi: {expiry_date})",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Menyu", callback_data="start")]]
-            ),
+        expiry_date = get_expiry_str(premium_users[user_id])
+        await edit_if_changed(
+            query,
+            f"ℹ️ Sizda allaqachon premium obuna mavjud!\n"
+            f"Tugash sanasi: {expiry_date}",
+            reply_markup=HOME_KB,
         )
         return
 
-    await query.edit_message_text(
-        "🔑 Premium kalitingizni kiriting (format: PREMIUM-XXXXXX):",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Bekor qilish", callback_data="start")]]
-        ),
+    await edit_if_changed(
+        query,
+        "🔑 Premium kalitingizni kiriting:\n\n"
+        "Masalan: PREMIUM-ABC123DEF456\n\n"
+        "Agar kalitingiz bo'lmasa, admin bilan bog'laning: "
+        f"@{ADMIN_USERNAME}",
+        reply_markup=BACK_TO_START_KB,
     )
-    user_data[user_id] = {"state": "waiting_key_activation"}
+    user_data[user_id] = UserSession(state=State.WAITING_KEY_ACTIVATION)
 
 
 async def process_key_activation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -468,18 +932,10 @@ async def process_key_activation(update: Update, context: ContextTypes.DEFAULT_T
     text = update.message.text.strip().upper()
 
     # Kalit formatini tekshirish
-    if not re.match(r"^PREMIUM-[A-Z0-9]{8,12}$", text):
+    if not is_valid_key_format(text):
         await update.message.reply_text(
             "❌ Noto'g'ri kalit formati! To'g'ri format: PREMIUM-ABC123",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "🔄 Qayta urinish", callback_data="activate_key"
-                        )
-                    ]
-                ]
-            ),
+            reply_markup=RETRY_KEY_KB,
         )
         return
 
@@ -487,20 +943,7 @@ async def process_key_activation(update: Update, context: ContextTypes.DEFAULT_T
     if text not in generated_keys:
         await update.message.reply_text(
             "❌ Noto'g'ri kalit yoki kalit mavjud emas!",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "🔄 Qayta urinish", callback_data="activate_key"
-                        )
-                    ],
-                    [
-                        InlineKeyboardButton(
-                            "🆙 Premium so'rov", callback_data="request_premium"
-                        )
-                    ],
-                ]
-            ),
+            reply_markup=RETRY_KEY_OR_REQUEST_KB,
         )
         return
 
@@ -510,135 +953,116 @@ async def process_key_activation(update: Update, context: ContextTypes.DEFAULT_T
     if key_data["user_id"] is not None:
         await update.message.reply_text(
             "❌ Bu kalit allaqachon ishlatilgan!",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "Admin bilan bog'lanish", url=f"t.me/{ADMIN_USERNAME}"
-                        )
-                    ]
-                ]
-            ),
+            reply_markup=CONTACT_ADMIN_KB,
         )
         return
 
     # Premiumni faollashtirish
+    expiry_date = get_expiry_str(key_data)
     premium_users[user_id] = {
         "expiry": key_data["expiry"],
+        "expiry_str": expiry_date,
         "key": text,
         "admin_id": key_data["admin_id"],
         "days": key_data["days"],
+        "username": update.effective_user.username,
     }
-    generated_keys[text]["user_id"] = user_id
+    key_data["user_id"] = user_id
+    # Kalit bilan faollashtirilgan bo'lsa, kutilayotgan so'rov endi kerak emas
+    if pending_requests.pop(user_id, None) is not None:
+        mark_dirty(PENDING_REQUESTS_FILE)
 
-    save_data(PREMIUM_USERS_FILE, premium_users)
-    save_data(GENERATED_KEYS_FILE, generated_keys)
+    mark_dirty(PREMIUM_USERS_FILE, GENERATED_KEYS_FILE)
 
-    expiry_date = key_data["expiry"].strftime("%Y-%m-%d")
     await update.message.reply_text(
         f"""🎉 Premium faollashtirildi!
 ⏳ Davomiylik: {key_data['days']} kun
 📅 Tugash sanasi: {expiry_date}
 
 Endi siz barcha funksiyalardan foydalanishingiz mumkin!""",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🏠 Menyu", callback_data="start")]]
-        ),
+        reply_markup=START_MENU_KB,
     )
 
     # Faollashtirish holatini tozalash
-    if user_id in user_data and "state" in user_data[user_id]:
-        del user_data[user_id]["state"]
+    if user_id in user_data:
+        user_data[user_id].state = State.IDLE
 
 
 async def generate_test_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_admin(update.effective_user.id):
+    if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Faqat adminlar uchun!")
         return
 
-    key, expiry = await generate_premium_key(None, None, days=30)
+    key, _ = await generate_premium_key(None, None, days=30)
     await update.message.reply_text(
-        f"Test Premium kaliti:\n<code>{key}</code>\nTugash sanasi: {expiry.strftime('%Y-%m-%d')}",
+        f"Test Premium kaliti:\n<code>{key}</code>\nTugash sanasi: {generated_keys[key]['expiry_str']}",
         parse_mode="HTML",
     )
 
 
-async def request_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-
-    if await is_premium(user_id):
-        await query.edit_message_text("✅ Sizda allaqachon premium obuna mavjud")
-        return
-
+async def request_premium(query, context, user_id):
+    """Premium so'rov yuborish"""
+    # Takroriy bosish eng ko'p uchraydi - avval oddiy lug'at tekshiruvi
     if user_id in pending_requests:
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "⏳ Sizning so'rovingiz ko'rib chiqilmoqda\n" f"Admin: @{ADMIN_USERNAME}",
-            reply_markup=InlineKeyboardMarkup(
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
         return
 
+    if await is_premium(user_id):
+        await edit_if_changed(query, "✅ Sizda allaqachon premium obuna mavjud")
+        return
+
     pending_requests[user_id] = {
         "username": query.from_user.username,
         "date": datetime.now(),
         "user_id": user_id,
     }
-    save_data(PENDING_REQUESTS_FILE, pending_requests)
-
+    mark_dirty(PENDING_REQUESTS_FILE)
+
+    # Foydalanuvchi javobi va admin xabari parallel yuboriladi
+    replies = [
+        query.edit_message_text(
+            "✅ Sizning premium so'rovingiz qabul qilindi!\n\n"
+            f"Admin: @{ADMIN_USERNAME}\n"
+            "Tasdiqlanishini kuting...",
+            reply_markup=BACK_TO_START_KB,
+        )
+    ]
     if ADMIN_ID:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"⚠️ Yangi premium so'rovi:\n\n"
-            f"Foydalanuvchi: @{query.from_user.username}\n"
-            f"ID: {user_id}\n\n"
-            f"Tasdiqlash: /approve_{user_id}",
+        replies.append(
+            context.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"⚠️ Yangi premium so'rov:\n\n"
+                f"Foydalanuvchi: @{query.from_user.username}\n"
+                f"ID: {user_id}\n\n"
+                f"Tasdiqlash: /approve_{user_id}",
+            )
         )
-
-    await query.edit_message_text(
-        "✅ Sizning premium so'rovingiz qabul qilindi!\n\n"
-        f"Admin: @{ADMIN_USERNAME}\n"
-        "Tasdiqlanishini kuting...",
-        reply_markup=InlineKeyboardMarkup(
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-        ),
-    )
+    await asyncio.gather(*replies)
 
 
 async def show_premium_info(query, user_id):
     """Premium holati haqida ma'lumot ko'rsatish"""
     if await is_premium(user_id):
-        expiry_date = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
-        await query.edit_message_text(
+        entry = premium_users[user_id]
+        await edit_if_changed(
+            query,
             f"⭐ Premium ma'lumot:\n\n"
-            f"🔑 Kalit: <code>{premium_users[user_id]['key']}</code>\n"
-            f"📅 Tugash sanasi: {expiry_date}\n"
-            f"⏳ Davomiylik: {premium_users[user_id]['days']} kun\n"
+            f"🔑 Kalit: <code>{entry['key']}</code>\n"
+            f"📅 Tugash sanasi: {get_expiry_str(entry)}\n"
+            f"⏳ Davomiylik: {entry['days']} kun\n"
             f"👤 Tasdiqlagan: @{ADMIN_USERNAME}",
             parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
     else:
-        buttons = []
-        if ADMIN_ID:
-            buttons.append(
-                [
-                    InlineKeyboardButton(
-                        "🆙 Premium so'rov", callback_data="request_premium"
-                    )
-                ]
-            )
-        buttons.append(
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-        )
-
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "❌ Sizda faol premium obuna mavjud emas",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=NO_PREMIUM_INFO_KB,
         )
 
 
@@ -649,39 +1073,30 @@ async def add_new_group(query, user_id):
         "Guruh havolasini yuboring:\n"
         "Masalan: https://t.me/guruhnomi yoki @guruhnomi\n\n"
         "Eslatma: Bot guruhda admin bo'lishi shart emas!",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-        ),
+        reply_markup=BACK_TO_START_KB,
     )
-    user_data[user_id] = {"state": "waiting_group_link"}
+    user_data[user_id] = UserSession(state=State.WAITING_GROUP_LINK)
 
 
 async def list_user_groups(query, user_id):
     """Foydalanuvchi guruhlarini ro'yxatini ko'rsatish"""
     if not user_groups.get(user_id):
-        keyboard = [
-            [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
 
         await query.edit_message_text(
             "❌ Sizda hozircha hech qanday guruh yo'q",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=GROUP_ADD_BACK_KB,
         )
         return
 
-    message = "📋 Sizning guruhlaringiz:\n\n"
+    lines = ["📋 Sizning guruhlaringiz:\n\n"]
     for idx, (group_id, group) in enumerate(user_groups[user_id].items(), 1):
         username = group.get("username", "noma'lum")
         link = group.get("link", "")
-        message += f"{idx}. @{username}\n👉 {link}\n\n"
-    keyboard = [
-        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-    ]
+        lines.append(f"{idx}. @{username}\n👉 {link}\n\n")
+    message = "".join(lines)
     await query.edit_message_text(
         message,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=GROUP_ADD_BACK_KB,
         parse_mode=ParseMode.MARKDOWN,
     )
 
@@ -689,157 +1104,103 @@ async def list_user_groups(query, user_id):
 async def process_group_link(update, context, user_id, text):
     """Guruh havolasini qayta ishlash"""
     try:
-        # Havoladan foydalanuvchi nomini ajratib olish
-        if text.startswith("https://t.me/"):
-            username = text.split("/")[-1]
-        elif text.startswith("@"):
-            username = text[1:]
-        else:
-            username = text  # @ belgisiz foydalanuvchi nomi deb hisoblash
-
-        # So'rov parametrlarini olib tashlash
-        username = username.split("?")[0]
+        # Havoladan foydalanuvchi nomini ajratib olish (so'rov parametrlarisiz)
+        match = _GROUP_LINK_RE.match(text)
+        username = match.group(1) if match else text
 
         # Guruh ma'lumotlarini vaqtincha saqlash
-        user_data[user_id] = {
-            "temp_group": {
+        user_data[user_id] = UserSession(
+            state=State.CONFIRMING_GROUP,
+            temp_group={
                 "username": username,
                 "link": (
                     f"https://t.me/{username}" if not text.startswith("http") else text
                 ),
             },
-            "state": "confirming_group",
-        }
+        )
 
         # Tasdiqlash tugmalarini ko'rsatish
         await update.message.reply_text(
             f"Guruh havolasi: https://t.me/{username}\n\nBu guruhni papkangizga qo'shishni xohlaysizmi?",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("✅ Ha", callback_data="confirm_add")],
-                    [InlineKeyboardButton("❌ Yo'q", callback_data="cancel_add")],
-                ]
-            ),
+            reply_markup=CONFIRM_GROUP_KB,
         )
 
     except Exception as e:
         logger.error(f"Guruh qo'shish xatosi: {str(e)}")
         await update.message.reply_text(
             f"❌ Xato: {str(e)}\nIltimos, qayta urinib ko'ring:",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
 
 
 async def confirm_group_addition(query, context, user_id):
     """Yangi guruh qo'shishni tasdiqlash"""
-    group_data = user_data.get(user_id, {}).get("temp_group")
+    group_data = user_data[user_id].temp_group
     if not group_data:
         await query.edit_message_text("❌ Guruh ma'lumotlari topilmadi")
         return
 
-    # Guruh uchun tasodifiy ID yaratish (admin bo'lmaganda haqiqiy ID ni olish mumkin emas)
-    group_id = abs(hash(group_data["username"])) % (10**8)  # 8 xonali pseudo ID
-
-    if user_id not in user_groups:
-        user_groups[user_id] = {}
-
     # Guruh allaqachon qo'shilganligini tekshirish (foydalanuvchi nomi bo'yicha)
-    existing_group = next(
-        (
-            g
-            for g in user_groups[user_id].values()
-            if g.get("username") == group_data["username"]
-        ),
-        None,
-    )
-
-    if existing_group:
-        keyboard = [
-            [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
+    usernames = _group_usernames[user_id]
+    if group_data["username"] in usernames:
         await query.edit_message_text(
             "⚠️ Bu guruh allaqachon qo'shilgan",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=GROUP_ADD_BACK_KB,
         )
     else:
-        user_groups[user_id][group_id] = {
+        groups = user_groups.setdefault(user_id, {})
+        # Guruh uchun ichki ID (admin bo'lmaganda haqiqiy chat ID ni olish mumkin emas):
+        # foydalanuvchi guruhlari orasida ketma-ket, qayta ishga tushganda o'zgarmaydi
+        group_id = max(groups, default=0) + 1
+        groups[group_id] = {
             "title": group_data["username"],  # Haqiqiy sarlavhani bilmaymiz
             "link": group_data["link"],
             "username": group_data["username"],
         }
-        save_data(USER_GROUPS_FILE, user_groups)
-
-        keyboard = [
-            [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-            [InlineKeyboardButton("📋 Mening guruhlarim", callback_data="list_groups")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
+        usernames.add(group_data["username"])
+        mark_dirty(USER_GROUPS_FILE)
 
         await query.edit_message_text(
             f"✅ @{group_data['username']} guruhi papkangizga qo'shildi!",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=GROUP_ADDED_KB,
         )
 
-    if user_id in user_data and "temp_group" in user_data[user_id]:
-        del user_data[user_id]["temp_group"]
+    if user_id in user_data:
+        user_data[user_id].temp_group = None
 
 
 async def cancel_group_addition(query, user_id):
     """Guruh qo'shish jarayonini bekor qilish"""
-    if user_id in user_data and "temp_group" in user_data[user_id]:
-        del user_data[user_id]["temp_group"]
-
-    keyboard = [
-        [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-    ]
+    if user_id in user_data:
+        user_data[user_id].temp_group = None
 
     await query.edit_message_text(
         "❌ Guruh qo'shish bekor qilindi",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=GROUP_ADD_BACK_KB,
     )
 
 
 async def create_auto_folder(query, user_id):
     """Guruhlar uchun avto-papka yaratish"""
     # Telegram hisobi ulanganligini tekshirish
-    if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-        "session"
-    ):
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "📲 Telegramni ulash", callback_data="connect_account"
-                )
-            ],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
+    if not _session_of(user_id):
         await query.edit_message_text(
             "❌ Avto-papka yaratish uchun avval Telegram hisobingizni ulashingiz kerak!",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=CONNECT_ACCOUNT_KB,
         )
         return
 
     if not user_groups.get(user_id):
-        keyboard = [
-            [InlineKeyboardButton("➕ Guruh qo'shish", callback_data="add_group")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
         await query.edit_message_text(
             "❌ Iltimos, avto-papka yaratish uchun avval guruhlar qo'shing",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=ADD_GROUP_KB,
         )
         return
 
     if user_id in auto_folders:
         await query.edit_message_text(
             "ℹ️ Sizda allaqachon avto-papka mavjud",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
         return
 
@@ -847,114 +1208,192 @@ async def create_auto_folder(query, user_id):
         "folder_name": "Avto-Papka",
         "groups": list(user_groups[user_id].keys()),
     }
-    save_data(AUTO_FOLDERS_FILE, auto_folders)
+    mark_dirty(AUTO_FOLDERS_FILE)
 
     await query.edit_message_text(
         "✅ Avto-papka muvaffaqiyatli yaratildi!\n\n"
         "Endi siz bir vaqtning o'zida ushbu papkadagi barcha guruhlarga xabar yuborishingiz mumkin.",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-        ),
+        reply_markup=BACK_TO_START_KB,
     )
 
 
 async def prepare_to_send_message(query, user_id):
     """Guruhlarga xabar yuborishni tayyorlash"""
     # Avval telegram hisobi ulanganligini tekshirish
-    if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-        "session"
-    ):
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "📲 Telegramni ulash", callback_data="connect_account"
-                )
-            ],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
-        await query.edit_message_text(
+    if not _session_of(user_id):
+        await edit_if_changed(
+            query,
             "❌ Xabar yuborish uchun avval Telegram hisobingizni ulashingiz kerak!",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=CONNECT_ACCOUNT_KB,
         )
         return
 
     if not user_groups.get(user_id) and not auto_folders.get(user_id):
-        keyboard = [
-            [InlineKeyboardButton("➕ Guruh Qo'shish", callback_data="add_group")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "❌ Iltimos, avval guruhlar qo'shing",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=ADD_GROUP_KB,
         )
         return
 
-    user_data[user_id] = {"state": "waiting_message"}
-    await query.edit_message_text(
+    user_data[user_id] = UserSession(state=State.WAITING_MESSAGE)
+    await edit_if_changed(
+        query,
         "Xabar matnini yuboring (bu xabar interval bilan guruhlarga yuboriladi):",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-        ),
+        reply_markup=BACK_TO_START_KB,
     )
 
 
-async def process_message_text(update, context, user_id, text):
-    """Xabar matnini qayta ishlash"""
-    user_data[user_id] = {"message": text, "state": "waiting_interval"}
+def _preview(msg: str, n: int = 200) -> str:
+    """Xabarning qisqa ko'rinishi (uzun bo'lsa kesiladi)"""
+    return msg if len(msg) <= n else msg[:n] + "..."
 
-    # Standart interval variantlari
-    default_intervals = ["1", "2", "5", "10", "30"]
-    if user_data.get(user_id, {}).get("interval"):
-        default_intervals.insert(0, str(user_data[user_id]["interval"]))
 
-    keyboard = [
-        [
-            InlineKeyboardButton(f"{m} daqiqa", callback_data=f"interval_{m}")
-            for m in default_intervals[:3]
-        ],
+def build_interval_markup(intervals):
+    """Interval tanlash klaviaturasini yaratish"""
+    return InlineKeyboardMarkup(
         [
-            InlineKeyboardButton(f"{m} daqiqa", callback_data=f"interval_{m}")
-            for m in default_intervals[3:]
-        ],
-        [InlineKeyboardButton("✏️ Boshqa interval", callback_data="custom_interval")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-    ]
+            [
+                InlineKeyboardButton(f"{m} daqiqa", callback_data=f"interval_{m}")
+                for m in intervals[:3]
+            ],
+            [
+                InlineKeyboardButton(f"{m} daqiqa", callback_data=f"interval_{m}")
+                for m in intervals[3:]
+            ],
+            [
+                InlineKeyboardButton(
+                    "✏️ Boshqa interval", callback_data="custom_interval"
+                )
+            ],
+            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
+        ]
+    )
+
+
+# Standart interval variantlari (oldingi interval bo'lmaganda o'zgarmaydi)
+_DEFAULT_INTERVALS = ("1", "2", "5", "10", "30")
+DEFAULT_INTERVALS_KB = build_interval_markup(_DEFAULT_INTERVALS)
+
+
+async def process_message_text(update, context, user_id, text):
+    """Xabar matnini qayta ishlash"""
+    previous_interval = user_data[user_id].interval
+    user_data[user_id] = UserSession(
+        state=State.WAITING_INTERVAL,
+        message=text,
+        preview=_preview(text),
+        interval=previous_interval,
+    )
+
+    reply_markup = DEFAULT_INTERVALS_KB
+    # Oldingi interval standart variantlardan biri bo'lsa, takroran qo'shilmaydi
+    if previous_interval and str(previous_interval) not in _DEFAULT_INTERVALS:
+        reply_markup = build_interval_markup(
+            (str(previous_interval),) + _DEFAULT_INTERVALS
+        )
 
     await update.message.reply_text(
         "Xabar yuborish intervalini tanlang:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=reply_markup,
     )
 
 
+# Telegram 4096 belgidan uzun matnni bir nechta xabarga bo'lib yuboradi
+TEXT_SPLIT_LEN = 4000  # shundan uzun qism - davomi kelishi mumkin
+TEXT_SPLIT_WAIT = 2.0  # soniya - keyingi qismni kutish
+_text_parts = {}  # {user_id: [str]} - yig'ilayotgan uzun xabar qismlari
+_text_flush_jobs = {}  # {user_id: Job}
+
+
+async def collect_message_text(update, context, user_id, text):
+    """Bo'lingan uzun xabar qismlarini yig'ib, bitta xabar sifatida qayta ishlash"""
+    parts = _text_parts.setdefault(user_id, [])
+    parts.append(text)
+    job = _text_flush_jobs.pop(user_id, None)
+    if job is not None:
+        job.schedule_removal()
+
+    # Qisqa xabar darhol qayta ishlanadi, uzun qismdan keyin davomi kutiladi
+    if len(text) >= TEXT_SPLIT_LEN:
+        _text_flush_jobs[user_id] = context.job_queue.run_once(
+            flush_message_text,
+            TEXT_SPLIT_WAIT,
+            data=update,
+            name=f"text_{user_id}",
+            user_id=user_id,
+        )
+        return
+
+    del _text_parts[user_id]
+    await process_message_text(update, context, user_id, "\n".join(parts))
+
+
+async def flush_message_text(context: ContextTypes.DEFAULT_TYPE):
+    """Davomi kelmagan uzun xabarni qayta ishlash"""
+    user_id = context.job.user_id
+    async with _user_locks[user_id]:
+        _text_flush_jobs.pop(user_id, None)
+        parts = _text_parts.pop(user_id, None)
+        # Foydalanuvchi kutish vaqtida boshqa bo'limga o'tgan bo'lsa - bekor qilinadi
+        if parts and user_data[user_id].state == State.WAITING_MESSAGE:
+            await process_message_text(
+                context.job.data, context, user_id, "\n".join(parts)
+            )
+
+
 async def set_message_interval(query, user_id):
     """Xabar yuborish intervalini sozlash"""
-    current_interval = user_data.get(user_id, {}).get("interval", "o'rnatilmagan")
-
-    keyboard = [
-        [InlineKeyboardButton("1 min", callback_data="interval_1")],
-        [InlineKeyboardButton("2 min", callback_data="interval_2")],
-        [InlineKeyboardButton("5 min", callback_data="interval_5")],
-        [InlineKeyboardButton("10 min", callback_data="interval_10")],
-        [InlineKeyboardButton("30 min", callback_data="interval_30")],
-        [InlineKeyboardButton("✏️ Boshqa", callback_data="custom_interval")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-    ]
+    current_interval = user_data[user_id].interval or "o'rnatilmagan"
 
-    await query.edit_message_text(
+    await edit_if_changed(
+        query,
         f"Joriy interval: {current_interval} min\n\nYangi intervalni tanlang:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=INTERVAL_MENU_KB,
     )
 
 
 async def request_custom_interval(query, user_id):
     """Foydalanuvchidan maxsus intervalni so'rash"""
-    user_data[user_id] = {"state": "waiting_interval"}
-    await query.edit_message_text(
+    session = user_data[user_id]
+    session.state = State.WAITING_INTERVAL  # xabar matni saqlanib qoladi
+    session.updated = time.monotonic()
+    await edit_if_changed(
+        query,
         "Intervalni daqiqalarda kiriting (masalan: 15):",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Orqaga", callback_data="set_interval")]]
-        ),
+        reply_markup=SET_INTERVAL_BACK_KB,
+    )
+
+
+def reschedule_user_job(job_queue, user_id, interval, message):
+    """Foydalanuvchi xabar ishini yaratish yoki joyida qayta rejalashtirish"""
+    data = {"user_id": user_id, "message": message}
+    schedule = {"message": message, "interval": interval}
+    if schedules.get(user_id) != schedule:
+        schedules[user_id] = schedule
+        mark_dirty(SCHEDULES_FILE)
+    job = message_jobs.get(user_id)
+    if job is not None and not job.removed:
+        # Interval ham, matn ham o'zgarmagan bo'lsa - jadvalga tegilmaydi
+        if job.data == data and job.job.trigger.interval == timedelta(minutes=interval):
+            return job
+        # Mavjud ishni o'chirib qayta yaratmasdan, joyida qayta rejalashtirish
+        job.data = data
+        job.job.reschedule(
+            trigger="interval",
+            seconds=interval * 60,
+            start_date=datetime.now(pytz.utc) + timedelta(seconds=5),
+        )
+        return job
+
+    job = message_jobs[user_id] = job_queue.run_repeating(
+        callback=send_user_messages,
+        interval=interval * 60,  # daqiqalarni sekundga aylantirish
+        first=5,  # 5 soniyadan keyin birinchi xabar
+        data=data,
+        name=f"user_{user_id}_messages",
     )
+    return job
 
 
 async def apply_message_interval(query, context, user_id, interval):
@@ -963,78 +1402,315 @@ async def apply_message_interval(query, context, user_id, interval):
         if not context.job_queue:
             raise RuntimeError("JobQueue ishga tushmagan")
 
-        if user_id not in user_data or "message" not in user_data[user_id]:
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "✉️ Xabar Yuborish", callback_data="send_message"
-                    )
-                ],
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-            ]
-
-            await query.edit_message_text(
+        if not user_data[user_id].message:
+            await edit_if_changed(
+                query,
                 "❌ Xabar topilmadi. Iltimos, qayta urinib ko'ring",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=SEND_MESSAGE_KB,
             )
             return
 
-        user_data[user_id]["interval"] = interval
-
-        # Avvalgi ishlarni to'xtatish
-        if user_id in message_jobs:
-            for job in message_jobs[user_id]:
-                job.schedule_removal()
-            del message_jobs[user_id]
-
-        message = user_data[user_id]["message"]
-        job = context.job_queue.run_repeating(
-            callback=send_user_messages,
-            interval=interval * 60,  # daqiqalarni sekundga aylantirish
-            first=5,  # 5 soniyadan keyin birinchi xabar
-            data={"user_id": user_id, "message": message},
-            name=f"user_{user_id}_messages",
-        )
-
-        message_jobs[user_id] = [job]
+        session = user_data[user_id]
+        session.interval = interval
+        message = session.message
+        reschedule_user_job(context.job_queue, user_id, interval, message)
 
-        keyboard = [
-            [InlineKeyboardButton("🛑 To'xtatish", callback_data="stop_messages")],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-        ]
-
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             f"✅ Sozlamalar saqlandi!\n\n"
             f"Xabarlar har {interval} daqiqada yuboriladi\n\n"
-            f"Xabar matni:\n{message[:200]}{'...' if len(message) > 200 else ''}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            f"Xabar matni:\n{session.preview or _preview(message)}",
+            reply_markup=STOP_MESSAGES_KB,
         )
 
     except Exception as e:
         logger.error(f"Interval xatosi: {str(e)}")
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             f"❌ Xato: {str(e)}\nIltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [InlineKeyboardButton("🔙 Bosh Menyu", callback_data="back_to_start")]
-            ),
+            reply_markup=BACK_TO_START_KB,
+        )
+
+
+def _cancel_user_job(user_id):
+    """Foydalanuvchining xabar ishini (bo'lsa) bekor qilish"""
+    job = message_jobs.pop(user_id, None)
+    if job is not None:
+        job.schedule_removal()
+    if schedules.pop(user_id, None) is not None:
+        mark_dirty(SCHEDULES_FILE)
+
+
+def _scheduled_session(user_id):
+    """Faol jadvaldagi xabar va interval bilan yangi sessiya"""
+    schedule = schedules[user_id]
+    return UserSession(
+        message=schedule["message"],
+        preview=_preview(schedule["message"]),
+        interval=schedule["interval"],
+    )
+
+
+def restore_scheduled_messages(job_queue):
+    """Saqlangan xabar jadvallarini qayta ishga tushganda tiklash"""
+    for user_id, schedule in schedules.items():
+        reschedule_user_job(
+            job_queue, user_id, schedule["interval"], schedule["message"]
         )
+        # Intervalni o'zgartirish uchun sessiyada xabar matni ham bo'lishi kerak
+        user_data[user_id] = _scheduled_session(user_id)
 
 
 async def stop_scheduled_messages(query, context, user_id):
     """Xabar yuborishni to'xtatish"""
-    if user_id in message_jobs:
-        for job in message_jobs[user_id]:
-            job.schedule_removal()
-        del message_jobs[user_id]
+    _cancel_user_job(user_id)
+    await close_client(user_id)
 
-    await query.edit_message_text(
+    await edit_if_changed(
+        query,
         "✅ Xabar yuborish to'xtatildi",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-        ),
+        reply_markup=BACK_TO_START_KB,
+    )
+
+
+async def close_client(user_id):
+    """Foydalanuvchining ulangan clientini yopish"""
+    client = active_clients.pop(user_id, None)
+    _client_last_used.pop(user_id, None)
+    _peer_cache.pop(user_id, None)  # peerlar client xotirasiga bog'liq
+    if client is None or not client.is_connected:
+        return
+    # Uzilish paytidagi tarmoq xatolari muhim emas, boshqa xatolar yashirilmaydi
+    with suppress(OSError, RPCError):
+        await client.stop()
+
+
+async def close_login_client(user_id):
+    """Login jarayonidagi clientni uzish (xabar yuboruvchi clientga tegmaydi)"""
+    client = _login_clients.pop(user_id, None)
+    if client is None or not client.is_connected:
+        return
+    with suppress(OSError, RPCError):
+        await client.disconnect()
+
+
+def _make_client(user_id, session_string=None):
+    """Foydalanuvchi uchun Pyrogram client yaratish (xotirada, yangilanishlarsiz)"""
+    # Bot client orqali faqat yuboradi/login qiladi - update dispatcher kerak emas
+    return PyrogramClient(
+        name=f"user_{user_id}",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        session_string=session_string,
+        in_memory=True,
+        no_updates=True,
     )
 
 
+async def get_active_client(user_id):
+    """Foydalanuvchi uchun ulangan clientni olish yoki yangisini ishga tushirish"""
+    client = active_clients.get(user_id)
+    if client is not None and client.is_connected and client.is_initialized:
+        _client_last_used[user_id] = time.monotonic()
+        return client
+
+    await close_client(user_id)
+    client = _make_client(user_id, _session_of(user_id))
+    await client.start()
+    remember_client(user_id, client)
+    return client
+
+
+def remember_client(user_id, client):
+    """Clientni keyingi foydalanish uchun saqlash"""
+    active_clients[user_id] = client
+    _client_last_used[user_id] = time.monotonic()
+
+
+async def evict_idle_clients(context: ContextTypes.DEFAULT_TYPE):
+    """Uzoq ishlatilmagan clientlarni yopish (faol xabar ishi bo'lganlardan tashqari)"""
+    deadline = time.monotonic() - CLIENT_IDLE_TIMEOUT
+    for user_id, last_used in list(_client_last_used.items()):
+        if last_used < deadline and user_id not in message_jobs:
+            await close_client(user_id)
+
+
+async def expire_old_requests(context: ContextTypes.DEFAULT_TYPE):
+    """Uzoq vaqt ko'rib chiqilmagan premium so'rovlarni o'chirish"""
+    deadline = datetime.now() - timedelta(days=PENDING_REQUEST_TTL_DAYS)
+    expired = [
+        user_id
+        for user_id, request in pending_requests.items()
+        if request.get("date") and request["date"] < deadline
+    ]
+    for user_id in expired:
+        del pending_requests[user_id]
+    if expired:
+        mark_dirty(PENDING_REQUESTS_FILE)
+
+
+# Login client faqat shu bosqichlarda kerak
+_LOGIN_STATES = (State.WAITING_VERIFICATION_CODE, State.WAITING_PASSWORD)
+
+
+async def expire_stale_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Tashlab ketilgan jarayonlarni (API ID, kod, guruh havolasi...) bekor qilish"""
+    deadline = time.monotonic() - SESSION_TTL
+    for user_id, session in list(user_data.items()):
+        if session.updated >= deadline:
+            continue
+        if user_id in schedules:
+            # Faol jadval matni saqlanadi - intervalni o'zgartirishda kerak bo'ladi
+            if session.state != State.IDLE:
+                user_data[user_id] = _scheduled_session(user_id)
+        # Faqat oxirgi interval saqlanadi (keyingi safar tanlov ro'yxatida chiqadi)
+        elif session.interval:
+            if session.state != State.IDLE or session.message:
+                user_data[user_id] = UserSession(interval=session.interval)
+        else:
+            del user_data[user_id]
+
+    # Bo'sh turgan bucket va locklar o'chiriladi (kerak bo'lsa qayta yaratiladi)
+    for user_id, bucket in list(_callback_buckets.items()):
+        if bucket.is_idle():
+            del _callback_buckets[user_id]
+    for user_id, lock in list(_user_locks.items()):
+        if not lock.locked() and user_id not in user_data:
+            del _user_locks[user_id]
+
+    # Login bosqichidan chiqqan foydalanuvchilarning login clientlari uziladi
+    for user_id in list(_login_clients):
+        session = user_data.get(user_id)
+        if session is None or session.state not in _LOGIN_STATES:
+            await close_login_client(user_id)
+
+
+# Bir vaqtda yuboriladigan xabarlar soni (flood limitlaridan saqlanish uchun)
+_SEND_SEMAPHORE = asyncio.Semaphore(5)
+
+# Har bir foydalanuvchi uchun yuborish tezligi (xabar/soniya)
+SEND_RATE = 20
+SEND_BURST = 20
+# Shundan qisqa FloodWait bo'lsa xabar kutib qayta yuboriladi (soniya)
+FLOOD_RETRY_MAX = 60
+
+
+class TokenBucket:
+    """Yuborish tezligini cheklash (faqat kerak bo'lganda kutadi)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Bitta token olish, yetmasa to'lguncha kutish"""
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def try_acquire(self):
+        """Token bo'lsa olish, bo'lmasa kutmasdan False qaytarish"""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def drain(self, seconds):
+        """FloodWait bo'lganda keyingi yuborishlarni kechiktirish"""
+        # Bir vaqtda kelgan FloodWait'lar qo'shilmaydi - eng uzuni olinadi
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self):
+        """To'la va to'lish vaqtidan uzoq ishlatilmagan (o'chirsa bo'ladi)"""
+        elapsed = time.monotonic() - self.updated
+        return (
+            elapsed >= self.capacity / self.rate
+            and self.tokens + elapsed * self.rate >= self.capacity
+        )
+
+
+_send_buckets = {}  # {user_id: TokenBucket}
+_peer_cache = {}  # {user_id: {username: InputPeer}} - client yopilguncha amal qiladi
+
+# Guruh peeri endi yaroqsiz bo'lganda keshdan o'chiriladi
+_STALE_PEER_ERRORS = (
+    PeerIdInvalid,
+    ChannelInvalid,
+    ChannelPrivate,
+    UsernameInvalid,
+    UsernameNotOccupied,
+)
+
+
+def get_send_bucket(user_id):
+    """Foydalanuvchining token bucketini olish"""
+    bucket = _send_buckets.get(user_id)
+    if bucket is None:
+        bucket = _send_buckets[user_id] = TokenBucket(SEND_RATE, SEND_BURST)
+    return bucket
+
+
+async def send_to_group(client, bucket, peers, group, text, entities):
+    """Bitta guruhga xabar yuborish (1 - yuborildi, 0 - xato)"""
+    username = group["username"]
+    for attempt in range(2):
+        # FloodWait dan keyin token bucket aynan server so'ragan vaqtcha kutadi;
+        # kutish semafordan tashqarida - boshqa yuborishlarni band qilmaydi
+        await bucket.acquire()
+        async with _SEND_SEMAPHORE:
+            try:
+                # Username faqat birinchi marta aniqlanadi, keyin keshdagi peer
+                peer = peers.get(username)
+                if peer is None:
+                    peer = peers[username] = await client.resolve_peer(f"@{username}")
+
+                await client.invoke(
+                    raw.functions.messages.SendMessage(
+                        peer=peer,
+                        message=text,
+                        random_id=client.rnd_id(),
+                        entities=entities,
+                    )
+                )
+                return 1
+            except _STALE_PEER_ERRORS as e:
+                peers.pop(username, None)
+                logger.error(f"Xabar yuborishda xato {username}: {str(e)}")
+                return 0
+            except FloodWait as e:
+                bucket.drain(e.value)
+                logger.error(f"FloodWait {username}: {e.value} soniya")
+                # Uzoq kutish talab qilinsa keyingi davrga qoldiriladi
+                if attempt or e.value > FLOOD_RETRY_MAX:
+                    return 0
+            except Exception as e:
+                logger.error(f"Xabar yuborishda xato {username}: {str(e)}")
+                return 0
+    return 0
+
+
+async def send_report(bot, user_id, text):
+    """Yuborish hisobotini foydalanuvchiga jo'natish (xato faqat loglanadi)"""
+    # Fon vazifasida update yo'q - xato error_handler ga emas, shu yerda loglanadi
+    try:
+        await bot.send_message(chat_id=user_id, text=text)
+    except TelegramError as e:
+        logger.error(f"Hisobot yuborishda xato {user_id}: {str(e)}")
+
+
 async def send_user_messages(context: ContextTypes.DEFAULT_TYPE):
     """Foydalanuvchi guruhlariga xabarlarni yuborish"""
     try:
@@ -1043,56 +1719,54 @@ async def send_user_messages(context: ContextTypes.DEFAULT_TYPE):
         message = job.data["message"]
 
         # Telegram hisobi ulanganligini tekshirish
-        if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-            "session"
-        ):
+        if not _session_of(user_id):
             await context.bot.send_message(
                 chat_id=user_id,
                 text="❌ Telegram hisobingiz ulanmagan! Iltimos, avval hisobingizni ulang!",
             )
             return
 
+        # Guruhlar ro'yxati nusxasi: yuborish davomida foydalanuvchi guruh
+        # qo'shsa/o'chirsa ham shu ish boshidagi ro'yxat bilan ishlaydi
+        groups = tuple(user_groups.get(user_id, {}).values())
+        if not groups:
+            # Guruh yo'q bo'lsa client ishga tushirilmaydi
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="❌ Xabar hech qanday guruhga yuborilmadi. Guruhlaringizni tekshiring.",
+            )
+            return
+
         # Pyrogram client orqali xabarlarni yuborish
         try:
-            async with PyrogramClient(
-                name=f"user_{user_id}",
-                api_id=API_ID,
-                api_hash=API_HASH,
-                session_string=telegram_accounts[user_id]["session"],
-                in_memory=True,
-            ) as client:
-                yuborildi = 0
-                xato = 0
-
-                # Foydalanuvchi guruhlariga xabar yuborish
-                if user_id in user_groups:
-                    for group_id, group in user_groups[user_id].items():
-                        try:
-                            # Username orqali yuborish (haqiqiy ID bo'lmasa ham)
-                            await client.send_message(
-                                chat_id=f"@{group['username']}", text=message
-                            )
-                            yuborildi += 1
-                            await asyncio.sleep(1)  # Flooddan saqlanish
-                        except Exception as e:
-                            logger.error(
-                                f"Xabar yuborishda xato {group['username']}: {str(e)}"
-                            )
-                            xato += 1
-                            continue
-
-                # Foydalanuvchiga xabar yuborish haqida xabar
-                if yuborildi > 0:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ Xabar {yuborildi} guruhga yuborildi!"
-                        + (f" (Xato: {xato})" if xato > 0 else ""),
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="❌ Xabar hech qanday guruhga yuborilmadi. Guruhlaringizni tekshiring.",
-                    )
+            # Ulanish har safar qayta ochilmaydi, mavjud client ishlatiladi
+            client = await get_active_client(user_id)
+
+            # Foydalanuvchi guruhlariga parallel xabar yuborish
+            bucket = get_send_bucket(user_id)
+            peers = _peer_cache.setdefault(user_id, {})
+
+            # Matn har bir guruh uchun emas, bir marta formatlanadi
+            text, entities = (
+                await pyrogram_utils.parse_text_entities(client, message, None, None)
+            ).values()
+            results = await asyncio.gather(
+                *(
+                    send_to_group(client, bucket, peers, group, text, entities)
+                    for group in groups
+                )
+            )
+            yuborildi = sum(results)
+            xato = len(results) - yuborildi
+
+            # Foydalanuvchiga hisobot fonda yuboriladi - ish tugashini kutdirmaydi
+            if yuborildi > 0:
+                report = f"✅ Xabar {yuborildi} guruhga yuborildi!" + (
+                    f" (Xato: {xato})" if xato > 0 else ""
+                )
+            else:
+                report = "❌ Xabar hech qanday guruhga yuborilmadi. Guruhlaringizni tekshiring."
+            context.application.create_task(send_report(context.bot, user_id, report))
         except Exception as e:
             logger.error(f"Pyrogram client xatosi: {str(e)}")
             await context.bot.send_message(
@@ -1104,81 +1778,68 @@ async def send_user_messages(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Xabar yuborishda xato: {str(e)}")
 
 
-async def connect_telegram_account(query, user_id):
-    """Telegram hisobini ulash"""
-    try:
-        # Agar API ma'lumotlari kiritilmagan bo'lsa
-        if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-            "api_id"
-        ):
-            user_data[user_id] = {"state": "waiting_api_id"}
-            await query.edit_message_text(
-                "🔹 <b>Telegram API Sozlamalari</b>\n\n"
-                "API ID va API HASH ni olish uchun quyidagi videoni ko'ring:\n"
-                "👉 https://www.youtube.com/watch?v=8naENmP3rg4\n\n"
-                "Keyin API_ID ni kiriting:",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-                ),
-            )
-            return
-
-        # Agar telefon raqami kiritilmagan bo'lsa
-        if not telegram_accounts[user_id].get("phone"):
-            user_data[user_id] = {"state": "waiting_phone_number"}
-            await query.edit_message_text(
-                "📱 <b>Telegram hisobingizni ulang</b>\n\n"
-                "Telefon raqamingizni kiriting:\n"
-                "Masalan: <code>+998901234567</code>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-                ),
-            )
-            return
-
-        # Agar tasdiqlash kodi kutilayotgan bo'lsa
-        elif user_data.get(user_id, {}).get("state") == "waiting_verification_code":
-            await query.edit_message_text(
-                "🔑 Telegramdan kelgan 5 xonali kodni kiriting:\n"
-                "<b>Format:</b> <code>12_345</code> (qulaylik uchun guruhlab)",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-                ),
-            )
-            return
+@with_error_reply(
+    "Hisob ulash xatosi", "❌ Hisob ulashda xato. Iltimos, qayta urinib ko'ring."
+)
+async def connect_telegram_account(query, user_id):
+    """Telegram hisobini ulash"""
+    # Agar API ma'lumotlari kiritilmagan bo'lsa
+    if user_id not in telegram_accounts or not telegram_accounts[user_id].get("api_id"):
+        user_data[user_id] = UserSession(state=State.WAITING_API_ID)
+        await edit_if_changed(
+            query,
+            "🔹 <b>Telegram API Sozlamalari</b>\n\n"
+            "API ID va API HASH ni olish uchun quyidagi videoni ko'ring:\n"
+            "👉 https://www.youtube.com/watch?v=8naENmP3rg4\n\n"
+            "Keyin API_ID ni kiriting:",
+            parse_mode="HTML",
+            reply_markup=BACK_TO_START_KB,
+        )
+        return
 
-        # Agar parol kutilayotgan bo'lsa (2FA)
-        if user_data.get(user_id, {}).get("state") == "waiting_password":
-            await query.edit_message_text(
-                "🔒 Iltimos, 2FA parolingizni kiriting:",
-                reply_markup=InlineKeyboardMarkup(
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-                ),
-            )
-            return
+    # Agar telefon raqami kiritilmagan bo'lsa
+    if not telegram_accounts[user_id].get("phone"):
+        user_data[user_id] = UserSession(state=State.WAITING_PHONE_NUMBER)
+        await edit_if_changed(
+            query,
+            "📱 <b>Telegram hisobingizni ulang</b>\n\n"
+            "Telefon raqamingizni kiriting:\n"
+            "Masalan: <code>+998901234567</code>",
+            parse_mode="HTML",
+            reply_markup=BACK_TO_START_KB,
+        )
+        return
 
-        # Agar allaqachon ulangan bo'lsa
-        if telegram_accounts[user_id].get("session"):
-            await show_telegram_account_info(query, user_id)
-            return
+    # Agar tasdiqlash kodi kutilayotgan bo'lsa
+    elif user_data[user_id].state == State.WAITING_VERIFICATION_CODE:
+        await edit_if_changed(
+            query,
+            "🔑 Telegramdan kelgan 5 xonali kodni kiriting:\n"
+            "<b>Format:</b> <code>12_345</code> (qulaylik uchun guruhlab)",
+            parse_mode="HTML",
+            reply_markup=BACK_TO_START_KB,
+        )
+        return
 
-    except Exception as e:
-        logger.error(f"Hisob ulash xatosi: {str(e)}")
-        await query.edit_message_text(
-            "❌ Hisob ulashda xato. Iltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-            ),
+    # Agar parol kutilayotgan bo'lsa (2FA)
+    if user_data[user_id].state == State.WAITING_PASSWORD:
+        await edit_if_changed(
+            query,
+            "🔒 Iltimos, 2FA parolingizni kiriting:",
+            reply_markup=BACK_TO_START_KB,
         )
+        return
+
+    # Agar allaqachon ulangan bo'lsa
+    if telegram_accounts[user_id].get("session"):
+        await show_telegram_account_info(query, user_id)
+        return
 
 
 def is_valid_code_format(code: str) -> bool:
     """Kod formati 12_345 ko'rinishida ekanligini tekshiradi"""
     # 1. Faqat raqamlar va pastki chiziq bo'lishi kerak
-    if not re.fullmatch(r"^[\d_]+$", code):
+    if not _CODE_RE.fullmatch(code):
         return False
 
     # 2. Pastki chiziqlar orasida 3 ta raqam bo'lishi kerak
@@ -1191,76 +1852,81 @@ def is_valid_code_format(code: str) -> bool:
     return len(clean_code) in (5, 6, 7)
 
 
+# Qisqa FloodWait'larda kod yuborish qayta urinib ko'riladi
+SEND_CODE_ATTEMPTS = 3
+SEND_CODE_MAX_WAIT = 30  # soniya - bundan uzoq kutish foydalanuvchiga aytiladi
+
+
+async def get_login_client(user_id):
+    """Login uchun ulangan clientni olish yoki yaratish"""
+    client = _login_clients.get(user_id)
+    if client is not None and client.is_connected:
+        return client
+
+    await close_login_client(user_id)
+    client = _make_client(user_id)
+    await client.connect()
+    _login_clients[user_id] = client
+    return client
+
+
+async def send_code_with_retry(client, phone):
+    """Tasdiqlash kodini yuborish, qisqa FloodWait bo'lsa kutib qayta urinish"""
+    for attempt in range(SEND_CODE_ATTEMPTS):
+        try:
+            return await client.send_code(phone)
+        except FloodWait as e:
+            if e.value > SEND_CODE_MAX_WAIT or attempt == SEND_CODE_ATTEMPTS - 1:
+                raise
+            # Jitter - bir vaqtda kutgan so'rovlar birga qaytmasligi uchun
+            await asyncio.sleep(e.value * (1 + random.random() * 0.5))
+
+
 async def process_phone_number(update, context, user_id, text):
     """Telefon raqamini qayta ishlash va tasdiqlash kodini yuborish"""
     try:
         # Telefon raqamini tekshirish
-        if not re.match(r"^\+[0-9]{10,14}$", text):
+        if not _PHONE_RE.match(text):
             await update.message.reply_text(
                 "❌ Noto'g'ri telefon raqami formati! Iltimos, +998901234567 formatida kiriting."
             )
             return
 
-        # Pyrogram clientni ishga tushirish
-        client = PyrogramClient(
-            name=f"user_{user_id}",
-            api_id=API_ID,
-            api_hash=API_HASH,
-            in_memory=True,
-        )
-        await client.connect()
-
         # Telefon raqamiga kod yuborish
-        sent_code = await client.send_code(text)
+        client = await get_login_client(user_id)
+        sent_code = await send_code_with_retry(client, text)
 
-        # Ma'lumotlarni saqlash
-        telegram_accounts[user_id] = {
-            "phone": text,
-            "client": client,
-            "phone_code_hash": sent_code.phone_code_hash,
-        }
-        save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
+        # Ma'lumotlarni saqlash (API ma'lumotlari saqlanib qoladi)
+        telegram_accounts.setdefault(user_id, {}).update(
+            phone=text, phone_code_hash=sent_code.phone_code_hash
+        )
+        mark_dirty(TELEGRAM_ACCOUNTS_FILE)
 
-        user_data[user_id] = {"state": "waiting_verification_code"}
+        user_data[user_id] = UserSession(state=State.WAITING_VERIFICATION_CODE)
 
         await update.message.reply_text(
             "✅ Tasdiqlash kodi yuborildi! Iltimos, Telegramdan kelgan 5 xonali kodni kiriting:\n\n"
             "Kodni quyidagi formatda kiriting: <code>12-345</code> yoki <code>12_345</code>",
             parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "🔄 Kodni qayta yuborish", callback_data="resend_code"
-                        )
-                    ],
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-                ]
-            ),
+            reply_markup=RESEND_CODE_KB,
         )
 
     except FloodWait as e:
         wait_time = e.value
         await update.message.reply_text(
             f"❌ Juda ko'p urinishlar! Iltimos, {wait_time} soniya kutib turing.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
     except PhoneNumberInvalid:
         await update.message.reply_text(
             "❌ Noto'g'ri telefon raqami! Iltimos, to'g'ri raqam kiriting.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
     except Exception as e:
         logger.error(f"Telefon raqamini qayta ishlashda xato: {str(e)}", exc_info=True)
         await update.message.reply_text(
             f"❌ Tizim xatosi. Xato tafsilotlari: {str(e)}",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
 
 
@@ -1268,43 +1934,25 @@ async def process_verification_code(update, context, user_id, text):
     """Tasdiqlash kodini qayta ishlash"""
     try:
         # Faqat raqamlarni olib tashlash
-        clean_code = re.sub(r"[^0-9]", "", text)
+        clean_code = _NON_DIGIT_RE.sub("", text)
 
         # Kod uzunligini tekshirish
         if len(clean_code) != 5:
             await update.message.reply_text(
                 "❌ Kod 5 raqamdan iborat bo'lishi kerak! Iltimos, qayta kiriting.",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🔄 Qayta yuborish", callback_data="resend_code"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "🔙 Orqaga", callback_data="back_to_start"
-                            )
-                        ],
-                    ]
-                ),
+                reply_markup=RESEND_CODE_KB,
             )
             return
 
         # Client mavjudligini tekshirish
-        if (
-            user_id not in telegram_accounts
-            or "client" not in telegram_accounts[user_id]
-        ):
+        client = _login_clients.get(user_id)
+        if client is None or user_id not in telegram_accounts:
             await update.message.reply_text(
                 "❌ Ulanishda xato. Iltimos, qaytadan urinib ko'ring.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
+                reply_markup=BACK_TO_START_KB,
             )
             return
 
-        client = telegram_accounts[user_id]["client"]
         phone = telegram_accounts[user_id]["phone"]
         phone_code_hash = telegram_accounts[user_id]["phone_code_hash"]
 
@@ -1320,132 +1968,88 @@ async def process_verification_code(update, context, user_id, text):
             session_string = await client.export_session_string()
             telegram_accounts[user_id]["session"] = session_string
             telegram_accounts[user_id]["connected_at"] = datetime.now()
-            save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
+            mark_dirty(TELEGRAM_ACCOUNTS_FILE)
 
-            # Tozalash
+            # Tozalash - xabar yuborishda session orqali yangi client ochiladi
+            await close_login_client(user_id)
             if user_id in user_data:
                 del user_data[user_id]
 
             await update.message.reply_text(
                 "✅ Muvaffaqiyatli ulandi! Endi siz botning barcha funksiyalaridan foydalanishingiz mumkin.",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🏠 Bosh menyu", callback_data="back_to_start"
-                            )
-                        ]
-                    ]
-                ),
+                reply_markup=HOME_KB,
             )
 
         except SessionPasswordNeeded:
-            user_data[user_id] = {"state": "waiting_password"}
+            user_data[user_id] = UserSession(state=State.WAITING_PASSWORD)
             await update.message.reply_text(
                 "🔒 Hisobingizda 2-qadam autentifikatsiya yoqilgan. Iltimos, parolingizni kiriting:",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
+                reply_markup=BACK_TO_START_KB,
             )
 
         except PhoneCodeInvalid:
             await update.message.reply_text(
                 "❌ Noto'g'ri tasdiqlash kodi! Iltimos, yangi kod so'rang va qayta urinib ko'ring.",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🔄 Yangi kod so'rash", callback_data="resend_code"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "🔙 Orqaga", callback_data="back_to_start"
-                            )
-                        ],
-                    ]
-                ),
+                reply_markup=NEW_CODE_KB,
             )
 
         except Exception as e:
             logger.error(f"Kodni tekshirishda xato: {str(e)}", exc_info=True)
             await update.message.reply_text(
                 f"❌ Xatolik yuz berdi: {str(e)}\nIltimos, qayta urinib ko'ring.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
+                reply_markup=BACK_TO_START_KB,
             )
 
     except Exception as e:
         logger.error(f"Tasdiqlash kodini qayta ishlashda xato: {str(e)}", exc_info=True)
         await update.message.reply_text(
             "❌ Tizim xatosi. Iltimos, keyinroq qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
 
 
 async def resend_code_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+    query = update.callback_query  # button_handler allaqachon answer() qilgan
     user_id = query.from_user.id
 
     if user_id not in telegram_accounts or "phone" not in telegram_accounts[user_id]:
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "❌ Avval telefon raqamingizni kiriting!",
-            reply_markup=InlineKeyboardMarkup(
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
         return
 
     try:
-        client = PyrogramClient(
-            name=f"user_{user_id}",
-            api_id=API_ID,
-            api_hash=API_HASH,
-            in_memory=True,
-        )
-        await client.connect()
-
+        client = await get_login_client(user_id)
         phone = telegram_accounts[user_id]["phone"]
-        sent_code = await client.send_code(phone)
+        sent_code = await send_code_with_retry(client, phone)
 
         telegram_accounts[user_id]["phone_code_hash"] = sent_code.phone_code_hash
-        telegram_accounts[user_id]["client"] = client
-        save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
+        mark_dirty(TELEGRAM_ACCOUNTS_FILE)
 
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "✅ Yangi tasdiqlash kodi yuborildi! Iltimos, Telegramdan kelgan 5 xonali kodni kiriting.",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    InlineKeyboardButton(
-                        "🔄 Qayta yuborish", callback_data="resend_code"
-                    )
-                ],
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-            ),
+            reply_markup=RESEND_CODE_KB,
         )
 
     except Exception as e:
         logger.error(f"Kodni qayta yuborishda xato: {str(e)}")
-        await query.edit_message_text(
+        await edit_if_changed(
+            query,
             "❌ Kod yuborishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
 
 
 async def process_2fa_password(update, context, user_id, password):
     """2FA parolini qayta ishlash"""
     try:
-        if user_id not in user_data or "client" not in user_data[user_id]:
+        client = _login_clients.get(user_id)
+        if client is None:
             raise ValueError("Telegram ulanish jarayoni topilmadi")
 
-        client = user_data[user_id]["client"]
-
         # Parol bilan kirish
         await client.check_password(password=password)
 
@@ -1453,221 +2057,161 @@ async def process_2fa_password(update, context, user_id, password):
         session_string = await client.export_session_string()
         telegram_accounts[user_id]["session"] = session_string
         telegram_accounts[user_id]["connected_at"] = datetime.now()
-        save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
+        mark_dirty(TELEGRAM_ACCOUNTS_FILE)
 
-        await client.disconnect()
+        # Login client yopiladi - xabar yuborishda session orqali yangisi ochiladi
+        await close_login_client(user_id)
         if user_id in user_data:
             del user_data[user_id]
 
         await update.message.reply_text(
             "✅ Muvaffaqiyatli ulandi!",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "🏠 Asosiy menyu", callback_data="back_to_start"
-                        )
-                    ]
-                ]
-            ),
+            reply_markup=MAIN_MENU_KB,
         )
 
     except Exception as e:
         logger.error(f"2FA xatosi: {str(e)}")
         await update.message.reply_text(
             f"❌ Xato: {str(e)}\nIltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
+            reply_markup=BACK_TO_START_KB,
         )
         # Xato bo'lganda tozalash
-        if user_id in user_data and "client" in user_data[user_id]:
-            try:
-                await user_data[user_id]["client"].disconnect()
-            except:
-                pass
-            del user_data[user_id]
+        await close_login_client(user_id)
+        user_data.pop(user_id, None)
 
 
+@with_error_reply("Uzish xatosi")
 async def disconnect_telegram_account(query, user_id):
     """Telegram hisobini uzish"""
-    try:
-        if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-            "session"
-        ):
-            await query.edit_message_text(
-                "ℹ️ Sizda ulangan Telegram hisobi yo'q",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
-            )
-            return
+    if not _session_of(user_id):
+        await edit_if_changed(
+            query,
+            "ℹ️ Sizda ulangan Telegram hisobi yo'q",
+            reply_markup=BACK_TO_START_KB,
+        )
+        return
 
-        # Client mavjud bo'lsa uzish
-        if "client" in telegram_accounts[user_id]:
-            try:
-                await telegram_accounts[user_id]["client"].disconnect()
-            except:
-                pass
+    # Client mavjud bo'lsa uzish
+    await close_client(user_id)
+    await close_login_client(user_id)
 
-        # Sessionni tozalash, lekin API ma'lumotlarini saqlab qolish
-        telegram_accounts[user_id].pop("session", None)
-        telegram_accounts[user_id].pop("client", None)
-        telegram_accounts[user_id].pop("phone_code_hash", None)
-        save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
+    # Sessionni tozalash, lekin API ma'lumotlarini saqlab qolish
+    telegram_accounts[user_id].pop("session", None)
+    telegram_accounts[user_id].pop("phone_code_hash", None)
+    mark_dirty(TELEGRAM_ACCOUNTS_FILE)
 
-        await query.edit_message_text(
-            "✅ Telegram hisobi muvaffaqiyatli uzildi",
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "🏠 Asosiy menyu", callback_data="back_to_start"
-                        )
-                    ]
-                ]
-            ),
-        )
-    except Exception as e:
-        logger.error(f"Uzish xatosi: {str(e)}")
-        await query.edit_message_text(
-            "❌ Xato yuz berdi. Iltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
-        )
+    await edit_if_changed(
+        query,
+        "✅ Telegram hisobi muvaffaqiyatli uzildi",
+        reply_markup=MAIN_MENU_KB,
+    )
 
 
+@with_error_reply("Hisob ma'lumoti xatosi")
 async def show_telegram_account_info(query, user_id):
     """Ulangan Telegram hisobi haqida ma'lumot ko'rsatish"""
-    try:
-        if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-            "session"
-        ):
-            keyboard = [
-                [InlineKeyboardButton("📲 Ulash", callback_data="connect_account")],
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-            ]
-            await query.edit_message_text(
-                "❌ Sizda ulangan Telegram hisobi yo'q",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-            return
-
-        account = telegram_accounts.get(user_id, {})
-        connected_at = account.get("connected_at", datetime.now())
-        if isinstance(connected_at, str):
-            connected_at = datetime.fromisoformat(connected_at)
+    if not _session_of(user_id):
+        await edit_if_changed(
+            query,
+            "❌ Sizda ulangan Telegram hisobi yo'q",
+            reply_markup=CONNECT_ACCOUNT_KB,
+        )
+        return
 
-        phone = account.get("phone", "Noma'lum")
-        message = "📲 Ulangan Telegram Hisobi:\n\n"
-        message += f"📞 Telefon: {phone}\n"
-        message += f"🕒 Ulangan vaqt: {connected_at.strftime('%Y-%m-%d %H:%M')}\n"
+    account = telegram_accounts.get(user_id, {})
+    connected_at = account.get("connected_at", datetime.now())
+    if isinstance(connected_at, str):
+        connected_at = datetime.fromisoformat(connected_at)
 
-        if account.get("api_id"):
-            message += "\n✅ API ma'lumotlari mavjud\n"
+    phone = account.get("phone", "Noma'lum")
+    message = "📲 Ulangan Telegram Hisobi:\n\n"
+    message += f"📞 Telefon: {phone}\n"
+    message += f"🕒 Ulangan vaqt: {connected_at.strftime('%Y-%m-%d %H:%M')}\n"
 
-        await query.edit_message_text(
-            message,
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            "❌ Uzish", callback_data="disconnect_account"
-                        )
-                    ],
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")],
-                ]
-            ),
-        )
-    except Exception as e:
-        logger.error(f"Hisob ma'lumoti xatosi: {str(e)}")
-        await query.edit_message_text(
-            "❌ Xato yuz berdi. Iltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-            ),
-        )
+    if account.get("api_id"):
+        message += "\n✅ API ma'lumotlari mavjud\n"
 
+    await edit_if_changed(
+        query,
+        message,
+        reply_markup=ACCOUNT_INFO_KB,
+    )
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    text = update.message.text.strip()
-    state = user_data.get(user_id, {}).get("state")
 
+async def _handle_waiting_api_id(update, context, user_id, text):
+    """API_ID ni qabul qilish"""
     try:
-        if state == "waiting_api_id":
-            try:
-                api_id = int(text)
-                telegram_accounts[user_id] = {"api_id": api_id}
-                user_data[user_id] = {"state": "waiting_api_hash"}
-                await update.message.reply_text(
-                    "✅ API id qabul qilindi !\n\nEndi <b>API_HASH</b> ni kiriting:",
-                    parse_mode="HTML",
-                )
-            except ValueError:
-                await update.message.reply_text("❌ API_ID must be numbers only!")
-
-        elif state == "waiting_api_hash":
-            telegram_accounts[user_id]["api_hash"] = text
-            save_data(TELEGRAM_ACCOUNTS_FILE, telegram_accounts)
-            user_data[user_id] = {"state": "waiting_phone_number"}
-            await update.message.reply_text(
-                "✅ API malumotlari saqlandi!\n\n"
-                "endi telefon raqamingizni kiriting:\n"
-                "Misol uchun: <code>+1234567890</code>",
-                parse_mode="HTML",
-            )
-
-        if state == "waiting_phone_number":
-            await process_phone_number(update, context, user_id, text)
+        api_id = int(text)
+        telegram_accounts[user_id] = {"api_id": api_id}
+        user_data[user_id] = UserSession(state=State.WAITING_API_HASH)
+        await update.message.reply_text(
+            "✅ API id qabul qilindi !\n\nEndi <b>API_HASH</b> ni kiriting:",
+            parse_mode="HTML",
+        )
+    except ValueError:
+        await update.message.reply_text("❌ API_ID must be numbers only!")
 
-        if state == "waiting_verification_code":
-            await process_verification_code(update, context, user_id, text)
-            return
 
-        elif state == "waiting_password":
-            await process_2fa_password(update, context, user_id, text)
-        elif state == "waiting_group_link":
-            await process_group_link(update, context, user_id, text)
+async def _handle_waiting_api_hash(update, context, user_id, text):
+    """API_HASH ni qabul qilish va saqlash"""
+    telegram_accounts[user_id]["api_hash"] = text
+    mark_dirty(TELEGRAM_ACCOUNTS_FILE)
+    user_data[user_id] = UserSession(state=State.WAITING_PHONE_NUMBER)
+    await update.message.reply_text(
+        "✅ API malumotlari saqlandi!\n\n"
+        "endi telefon raqamingizni kiriting:\n"
+        "Misol uchun: <code>+1234567890</code>",
+        parse_mode="HTML",
+    )
 
-        elif state == "waiting_key_activation":
-            await process_key_activation(update, context)
 
-        elif state == "waiting_message":
-            await process_message_text(update, context, user_id, text)
+async def _handle_waiting_key_activation(update, context, user_id, text):
+    """Premium kalitni faollashtirish"""
+    await process_key_activation(update, context)
 
-        elif state == "waiting_interval":
-            try:
-                interval = int(text)
-                if interval < 1:
-                    raise ValueError("Interval 1 daqiqadan kam bo'lishi mumkin emas")
-
-                query = update.callback_query or update.message
-                await apply_message_interval(query, context, user_id, interval)
-
-            except ValueError:
-                await update.message.reply_text(
-                    "❌ Noto'g'ri interval! Faqat raqam kiriting (masalan: 15)",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="set_interval"
-                                )
-                            ]
-                        ]
-                    ),
-                )
 
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
+async def _handle_waiting_interval(update, context, user_id, text):
+    """Qo'lda kiritilgan intervalni qo'llash"""
+    # isdecimal manfiy va kasr sonlarni ham rad etadi - istisnosiz tekshiruv
+    if not text.isdecimal() or int(text) < 1:
         await update.message.reply_text(
-            "❌ System error. Please try again.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]]
-            ),
+            "❌ Noto'g'ri interval! Faqat raqam kiriting (masalan: 15)",
+            reply_markup=SET_INTERVAL_BACK_KB,
         )
+        return
+
+    query = update.callback_query or update.message
+    await apply_message_interval(query, context, user_id, int(text))
+
+
+# Foydalanuvchi holati -> matnli xabar handleri
+_STATE_HANDLERS = {
+    State.WAITING_API_ID: _handle_waiting_api_id,
+    State.WAITING_API_HASH: _handle_waiting_api_hash,
+    State.WAITING_PHONE_NUMBER: process_phone_number,
+    State.WAITING_VERIFICATION_CODE: process_verification_code,
+    State.WAITING_PASSWORD: process_2fa_password,
+    State.WAITING_GROUP_LINK: process_group_link,
+    State.WAITING_KEY_ACTIVATION: _handle_waiting_key_activation,
+    State.WAITING_MESSAGE: collect_message_text,
+    State.WAITING_INTERVAL: _handle_waiting_interval,
+}
+
+
+@per_user_lock
+@with_error_reply(
+    "Xabarni qayta ishlashda xato",
+    "❌ Tizim xatosi. Iltimos, qayta urinib ko'ring.",
+    HOME_KB,
+)
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    text = update.message.text.strip()
+    handler = _STATE_HANDLERS.get(user_data[user_id].state)
+    if handler is None:
+        return
+
+    await handler(update, context, user_id, text)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1695,537 +2239,145 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode="HTML")
 
 
+async def _on_connect_account(update, context, query, user_id):
+    """Hisob ulangan bo'lsa ma'lumot, aks holda ulash bosqichini ko'rsatish"""
+    if _session_of(user_id):
+        await show_telegram_account_info(query, user_id)
+    else:
+        await connect_telegram_account(query, user_id)
+
+
+async def _on_send_message(update, context, query, user_id):
+    """Xabar yuborish (faqat premium)"""
+    if not await is_premium(user_id):
+        await query.edit_message_text(
+            "🔒 Bu funksiya faqat premium foydalanuvchilar uchun",
+            reply_markup=PREMIUM_REQUIRED_KB,
+        )
+        return
+    await prepare_to_send_message(query, user_id)
+
+
+async def _on_back_to_start(update, context, query, user_id):
+    """Joriy jarayonni to'xtatib bosh menyuga qaytish"""
+    if user_id in user_data:
+        user_data[user_id].state = State.IDLE
+        user_data[user_id].temp_group = None
+    await start(update, context)
+
+
+# Aniq callback_data -> ishlovchi (update, context, query, user_id)
+_CALLBACK_HANDLERS = {
+    # Admin paneli
+    "admin_panel": lambda update, context, query, user_id: show_admin_panel(query),
+    "generate_key": lambda update, context, query, user_id: (
+        show_key_generation_options(query)
+    ),
+    "premium_users_list": lambda update, context, query, user_id: (
+        show_premium_users_list(query, context)
+    ),
+    "pending_requests": lambda update, context, query, user_id: (
+        show_pending_requests(query, context)
+    ),
+    # Telegram hisobi
+    "connect_account": _on_connect_account,
+    "resend_code": lambda update, context, query, user_id: (
+        resend_code_handler(update, context)
+    ),
+    "disconnect_account": lambda update, context, query, user_id: (
+        disconnect_telegram_account(query, user_id)
+    ),
+    # Xabar yuborish
+    "create_auto_folder": lambda update, context, query, user_id: (
+        create_auto_folder(query, user_id)
+    ),
+    "send_message": _on_send_message,
+    "set_interval": lambda update, context, query, user_id: (
+        set_message_interval(query, user_id)
+    ),
+    "custom_interval": lambda update, context, query, user_id: (
+        request_custom_interval(query, user_id)
+    ),
+    "stop_messages": lambda update, context, query, user_id: (
+        stop_scheduled_messages(query, context, user_id)
+    ),
+    # Premium
+    "request_premium": lambda update, context, query, user_id: (
+        request_premium(query, context, user_id)
+    ),
+    "activate_key": lambda update, context, query, user_id: (
+        activate_key(query, user_id)
+    ),
+    "premium_info": lambda update, context, query, user_id: (
+        show_premium_info(query, user_id)
+    ),
+    # Guruhlar
+    "add_group": lambda update, context, query, user_id: add_new_group(query, user_id),
+    "list_groups": lambda update, context, query, user_id: (
+        list_user_groups(query, user_id)
+    ),
+    "confirm_add": lambda update, context, query, user_id: (
+        confirm_group_addition(query, context, user_id)
+    ),
+    "cancel_add": lambda update, context, query, user_id: (
+        cancel_group_addition(query, user_id)
+    ),
+    # Menyu
+    "back_to_start": _on_back_to_start,
+    "start": lambda update, context, query, user_id: start(update, context),
+}
+
+# "<prefiks>_<son>" ko'rinishidagi callback_data uchun ishlovchilar
+_PREFIX_HANDLERS = {
+    "interval": apply_message_interval,
+    "genkey": _on_genkey,
+    "approve": _on_approve,
+}
+
+
+@rate_limited
+@per_user_lock
+@with_error_reply(
+    "Tugma boshqaruvchisida xatolik",
+    "❌ Xatolik yuz berdi. Iltimos, qayta urinib ko'ring.",
+    HOME_KB,
+)
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Barcha callback so'rovlarni boshqarish"""
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
     data = query.data
 
-    try:
-        # Admin paneli bilan bog'liq tugmalar
-        if data == "admin_panel":
-            if not await is_admin(user_id):
-                await query.edit_message_text("❌ Faqat adminlar uchun!")
-                return
-
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "🔑 Premium kalit yaratish", callback_data="generate_key"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "📊 Premium foydalanuvchilar",
-                        callback_data="premium_users_list",
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "📨 Kutilayotgan so'rovlar", callback_data="pending_requests"
-                    )
-                ],
-                [InlineKeyboardButton("🏠 Bosh menyu", callback_data="back_to_start")],
-            ]
-            await query.edit_message_text(
-                "🛠 Admin paneli:\n\nIltimos, amalni tanlang:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-            return
-        elif data == "resend_code":
-            await resend_code_handler(update, context)
-            return
-        elif data == "connect_account":
-            if user_id not in telegram_accounts or not telegram_accounts[user_id].get(
-                "api_id"
-            ):
-                user_data[user_id] = {"state": "waiting_api_id"}
-                await query.edit_message_text(
-                    "📋 Iltimos, API_ID ni kiriting:\n\n"
-                    "API ID va API HASH ni olish uchun quyidagi videoni ko'ring:\n"
-                    "👉 https://www.youtube.com/watch?v=8naENmP3rg4\n\n"
-                    "Keyin API_ID ni kiriting:",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="back_to_start"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-            elif not telegram_accounts[user_id].get("session"):
-                await connect_telegram_account(query, user_id)
-            else:
-                await show_telegram_account_info(query, user_id)
-            return
-
-        elif data == "create_auto_folder":
-            await create_auto_folder(query, user_id)
-            return
-
-        elif data == "send_message":
-            if not await is_premium(user_id):
-                await query.edit_message_text(
-                    "🔒 Bu funksiya faqat premium foydalanuvchilar uchun",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🆙 Premium so'rov", callback_data="request_premium"
-                                )
-                            ],
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="back_to_start"
-                                )
-                            ],
-                        ]
-                    ),
-                )
-                return
-
-            await prepare_to_send_message(query, user_id)
-            return
-
-        elif data.startswith("interval_"):
-            try:
-                interval = int(data.split("_")[1])
-                await apply_message_interval(query, context, user_id, interval)
-            except Exception as e:
-                logger.error(f"Interval tanlashda xatolik: {e}")
-                await query.edit_message_text(
-                    "❌ Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="back_to_start"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-            return
-
-        elif data == "custom_interval":
-            user_data[user_id] = {"state": "waiting_interval"}
-            await query.edit_message_text(
-                "Intervalni daqiqalarda kiriting (masalan: 15):",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="set_interval")]]
-                ),
-            )
-            return
-
-        elif data == "stop_messages":
-            await stop_scheduled_messages(query, context, user_id)
-            return
-
-        elif data == "disconnect_account":
-            await disconnect_telegram_account(query, user_id)
-            return
-
-        elif data == "generate_key":
-            if not await is_admin(user_id):
-                await query.edit_message_text("❌ Faqat adminlar kalit yarata oladi!")
-                return
-
-            keyboard = [
-                [InlineKeyboardButton("1 oy", callback_data="genkey_30")],
-                [InlineKeyboardButton("3 oy", callback_data="genkey_90")],
-                [InlineKeyboardButton("6 oy", callback_data="genkey_180")],
-                [InlineKeyboardButton("1 yil", callback_data="genkey_365")],
-                [InlineKeyboardButton("🔙 Orqaga", callback_data="admin_panel")],
-            ]
-            await query.edit_message_text(
-                "🔑 Kalit yaratish:\n\nDavomiyligini tanlang:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-            return
-
-        elif data.startswith("genkey_"):
-            if not await is_admin(user_id):
-                await query.answer("❌ Faqat adminlar uchun!", show_alert=True)
-                return
-
-            try:
-                days = int(data.split("_")[1])
-                key = generate_key()
-                expiry_date = datetime.now() + timedelta(days=days)
-
-                generated_keys[key] = {
-                    "user_id": None,
-                    "expiry": expiry_date,
-                    "admin_id": ADMIN_ID,
-                    "days": days,
-                }
-                save_data(GENERATED_KEYS_FILE, generated_keys)
-
-                await query.edit_message_text(
-                    f"✅ Premium kalit yaratildi:\n\n"
-                    f"🔑 Kalit: <code>{key}</code>\n"
-                    f"📅 Tugash sanasi: {expiry_date.strftime('%Y-%m-%d')}\n"
-                    f"⏳ Davomiyligi: {days} kun\n\n"
-                    "Bu kalitni foydalanuvchiga yuboring.",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🏠 Admin paneli", callback_data="admin_panel"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-                return
-
-            except Exception as e:
-                logger.error(f"Kalit yaratishda xatolik: {str(e)}")
-                await query.edit_message_text(
-                    f"❌ Xatolik: {str(e)}\n\nIltimos, qaytadan urinib ko'ring.",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="admin_panel"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-                return
-
-        elif data == "premium_users_list":
-            if not await is_admin(user_id):
-                await query.edit_message_text("❌ Faqat adminlar uchun!")
-                return
-
-            if not premium_users:
-                await query.edit_message_text(
-                    "ℹ️ Hozircha premium foydalanuvchilar yo'q"
-                )
-                return
-
-            message = "⭐ Premium foydalanuvchilar:\n\n"
-            for uid, data in premium_users.items():
-                username = next(
-                    (
-                        req["username"]
-                        for req in pending_requests.values()
-                        if req.get("user_id") == uid
-                    ),
-                    "Noma'lum",
-                )
-                expiry = data["expiry"].strftime("%Y-%m-%d")
-                message += f"👤 {username} (ID: {uid})\n"
-                message += f"📅 Tugash sanasi: {expiry}\n"
-                message += f"⏳ Davomiylik: {data['days']} kun\n\n"
-
-            await query.edit_message_text(
-                message,
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🏠 Admin paneli", callback_data="admin_panel"
-                            )
-                        ]
-                    ]
-                ),
-            )
-            return
-
-        elif data == "pending_requests":
-            if not await is_admin(user_id):
-                await query.edit_message_text("❌ Faqat adminlar uchun!")
-                return
-
-            if not pending_requests:
-                await query.edit_message_text(
-                    "ℹ️ Kutilayotgan so'rovlar yo'q",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🏠 Admin paneli", callback_data="admin_panel"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-                return
-
-            message = "📨 Kutilayotgan premium so'rovlar:\n\n"
-            buttons = []
-            for req_user_id, request in pending_requests.items():
-                message += f"👤 @{request['username']} (ID: {req_user_id})\n"
-                buttons.append(
-                    [
-                        InlineKeyboardButton(
-                            f"✅ Tasdiqlash {request['username']}",
-                            callback_data=f"approve_{req_user_id}",
-                        )
-                    ]
-                )
-
-            buttons.append(
-                [InlineKeyboardButton("🏠 Admin paneli", callback_data="admin_panel")]
-            )
-            await query.edit_message_text(
-                message, reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            return
-
-        elif data.startswith("approve_"):
-            if not await is_admin(user_id):
-                await query.edit_message_text("❌ Faqat adminlar uchun!")
-                return
-
-            user_id_to_approve = int(data.split("_")[1])
-            if user_id_to_approve not in pending_requests:
-                await query.edit_message_text("❌ Foydalanuvchi so'rovi topilmadi!")
-                return
-
-            key = generate_key()
-            expiry_date = datetime.now() + timedelta(days=30)
-
-            premium_users[user_id_to_approve] = {
-                "expiry": expiry_date,
-                "key": key,
-                "admin_id": ADMIN_ID,
-                "days": 30,
-            }
-
-            generated_keys[key] = {
-                "user_id": user_id_to_approve,
-                "expiry": expiry_date,
-                "admin_id": ADMIN_ID,
-                "days": 30,
-            }
-
-            user_info = pending_requests.pop(user_id_to_approve)
-            save_data(PREMIUM_USERS_FILE, premium_users)
-            save_data(GENERATED_KEYS_FILE, generated_keys)
-            save_data(PENDING_REQUESTS_FILE, pending_requests)
-
-            await context.bot.send_message(
-                chat_id=user_id_to_approve,
-                text=f"🎉 Sizning premium so'rovingiz tasdiqlandi!\n\n"
-                f"🔑 Sizning premium kalitingiz: <code>{key}</code>\n"
-                f"📅 Tugash sanasi: {expiry_date.strftime('%Y-%m-%d')}\n\n"
-                f"Endi siz botning barcha funksiyalaridan foydalanishingiz mumkin!",
-                parse_mode="HTML",
-            )
-
-            await query.edit_message_text(
-                f"✅ @{user_info['username']} premiumga tasdiqlandi!\n" f"Kalit: {key}",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🏠 Admin paneli", callback_data="admin_panel"
-                            )
-                        ]
-                    ]
-                ),
-            )
-            return
-
-        # Foydalanuvchi menyusi bilan bog'liq tugmalar
-        elif data == "back_to_start":
-            if user_id in user_data:
-                if "state" in user_data[user_id]:
-                    del user_data[user_id]["state"]
-                if "temp_group" in user_data[user_id]:
-                    del user_data[user_id]["temp_group"]
-
-            await start(update, context)
-            return
-
-        elif data == "request_premium":
-            if await is_premium(user_id):
-                await query.edit_message_text(
-                    "✅ Sizda allaqachon premium obuna mavjud"
-                )
-                return
-
-            if user_id in pending_requests:
-                await query.edit_message_text(
-                    "⏳ Sizning so'rovingiz ko'rib chiqilmoqda\n"
-                    f"Admin: @{ADMIN_USERNAME}",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="back_to_start"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-                return
-
-            pending_requests[user_id] = {
-                "username": query.from_user.username,
-                "date": datetime.now(),
-                "user_id": user_id,
-            }
-            save_data(PENDING_REQUESTS_FILE, pending_requests)
-
-            if ADMIN_ID:
-                await context.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=f"⚠️ Yangi premium so'rov:\n\n"
-                    f"Foydalanuvchi: @{query.from_user.username}\n"
-                    f"ID: {user_id}\n\n"
-                    f"Tasdiqlash: /approve_{user_id}",
-                )
-
-            await query.edit_message_text(
-                "✅ Sizning premium so'rovingiz qabul qilindi!\n\n"
-                f"Admin: @{ADMIN_USERNAME}\n"
-                "Tasdiqlanishini kuting...",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
-            )
-            return
-
-        elif data == "activate_key":
-            if await is_premium(user_id):
-                expiry_date = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
-                await query.edit_message_text(
-                    f"ℹ️ Sizda allaqachon premium obuna mavjud!\n"
-                    f"Tugash sanasi: {expiry_date}",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🏠 Bosh menyu", callback_data="back_to_start"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-                return
-
-            await query.edit_message_text(
-                "🔑 Premium kalitingizni kiriting:\n\n"
-                "Masalan: PREMIUM-ABC123DEF456\n\n"
-                "Agar kalitingiz bo'lmasa, admin bilan bog'laning: "
-                f"@{ADMIN_USERNAME}",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]]
-                ),
-            )
-            user_data[user_id] = {"state": "waiting_key_activation"}
-            return
-
-        elif data == "premium_info":
-            if await is_premium(user_id):
-                expiry_date = premium_users[user_id]["expiry"].strftime("%Y-%m-%d")
-                await query.edit_message_text(
-                    f"⭐ Premium ma'lumot:\n\n"
-                    f"🔑 Kalit: <code>{premium_users[user_id]['key']}</code>\n"
-                    f"📅 Tugash sanasi: {expiry_date}\n"
-                    f"⏳ Davomiylik: {premium_users[user_id]['days']} kun\n"
-                    f"👤 Tasdiqlagan: @{ADMIN_USERNAME}",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(
-                        [
-                            [
-                                InlineKeyboardButton(
-                                    "🔙 Orqaga", callback_data="back_to_start"
-                                )
-                            ]
-                        ]
-                    ),
-                )
-            else:
-                buttons = []
-                if ADMIN_ID:
-                    buttons.append(
-                        [
-                            InlineKeyboardButton(
-                                "🆙 Premium so'rov", callback_data="request_premium"
-                            )
-                        ]
-                    )
-                buttons.append(
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data="back_to_start")]
-                )
-
-                await query.edit_message_text(
-                    "❌ Sizda faol premium obuna mavjud emas",
-                    reply_markup=InlineKeyboardMarkup(buttons),
-                )
-            return
-
-        # Guruh bilan bog'liq tugmalar
-        elif data == "add_group":
-            await add_new_group(query, user_id)
-            return
-
-        elif data == "list_groups":
-            await list_user_groups(query, user_id)
-            return
-
-        elif data == "confirm_add":
-            await confirm_group_addition(query, context, user_id)
-            return
-
-        elif data == "cancel_add":
-            await cancel_group_addition(query, user_id)
-            return
-        elif data == "start":
-            await start(update, context)
-            return
-        # Noma'lum buyruq
-        else:
-            await query.edit_message_text(
-                "⚠️ Noma'lum buyruq",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🏠 Bosh menyu", callback_data="back_to_start"
-                            )
-                        ]
-                    ]
-                ),
-            )
-            return
+    # Raqamli parametrli tugmalar: interval_15, genkey_30, approve_<id>
+    prefix, _, arg = data.partition("_")
+    handler = _PREFIX_HANDLERS.get(prefix)
+    if handler is not None and arg.isdigit():
+        await handler(query, context, user_id, int(arg))
+        return
 
-    except Exception as e:
-        logger.error(f"Tugma boshqaruvchisida xatolik: {e}")
-        await query.edit_message_text(
-            "❌ Xatolik yuz berdi. Iltimos, qayta urinib ko'ring.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Bosh menyu", callback_data="back_to_start")]]
-            ),
-        )
+    handler = _CALLBACK_HANDLERS.get(data)
+    if handler is None:
+        await query.edit_message_text("⚠️ Noma'lum buyruq", reply_markup=HOME_KB)
+        return
+    await handler(update, context, query, user_id)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(msg="Exception occurred:", exc_info=context.error)
 
+    # Job va fon vazifalaridagi xatolarda update bo'lmaydi - javob beradigan joy yo'q
+    if not isinstance(update, Update):
+        return
+
     if update.callback_query:
         await update.callback_query.edit_message_text(
             "❌ System error occurred. Please try again later.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]]
-            ),
+            reply_markup=ERROR_FALLBACK_KB,
         )
     elif update.message:
         await update.message.reply_text(
             "❌ System error occurred. Please try again later.",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]]
-            ),
+            reply_markup=ERROR_FALLBACK_KB,
         )
 
 
@@ -2240,9 +2392,31 @@ async def set_bot_commands(application: Application):
     await application.bot.set_my_commands(commands=commands)
 
 
+async def on_shutdown(application: Application):
+    """To'xtashdan oldin clientlarni yopish va saqlanmagan ma'lumotlarni yozish"""
+    for user_id in list(active_clients):
+        await close_client(user_id)
+    for user_id in list(_login_clients):
+        await close_login_client(user_id)
+    flush_dirty()
+
+
 def main() -> None:
     """Main function - starts the bot."""
-    application = Application.builder().token(TOKEN).build()
+    if uvloop is not None:
+        uvloop.install()
+
+    # Handle updates concurrently; per_user_lock keeps each user's updates in order.
+    # PTB's default pool holds a single keep-alive connection, which would make the
+    # concurrent handlers queue for it, so give Bot API calls a bigger pool.
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(BOT_API_POOL_SIZE)
+        .pool_timeout(10)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -2265,9 +2439,53 @@ def main() -> None:
     # Set bot commands for menu
     application.add_handler(CommandHandler("setcommands", set_bot_commands))
     application.post_init = set_bot_commands
+    application.post_shutdown = on_shutdown
+
+    # Close Pyrogram clients that have been idle for a while
+    application.job_queue.run_repeating(
+        evict_idle_clients,
+        interval=CLIENT_IDLE_TIMEOUT,
+        first=CLIENT_IDLE_TIMEOUT,
+        name="evict_clients",
+    )
+
+    # Drop conversation states the user abandoned halfway
+    application.job_queue.run_repeating(
+        expire_stale_sessions,
+        interval=SESSION_TTL,
+        first=SESSION_TTL,
+        name="expire_sessions",
+    )
+
+    # Drop premium requests nobody approved within a week
+    application.job_queue.run_repeating(
+        expire_old_requests,
+        interval=timedelta(days=1),
+        first=60,
+        name="expire_requests",
+    )
+
+    # Re-create the message jobs that were running before the restart
+    restore_scheduled_messages(application.job_queue)
+
+    # Persist changed data files in one periodic pass
+    application.job_queue.run_repeating(
+        flush_dirty_job, interval=SAVE_INTERVAL, first=SAVE_INTERVAL, name="flush_data"
+    )
+
+    # Only request the update types that have handlers
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
     # Run the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            webhook_url=WEBHOOK_URL,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":